@@ -0,0 +1,151 @@
+"""
+Counts the sync/async thread hops Django's ASGI handler makes per HTTP request for:
+
+- before: ClearAuthenticationHeaderMiddleware sync-only
+- after: ClearAuthenticationHeaderMiddleware sync/async capable (the project settings)
+- async-stack: as "after", with WhiteNoise and OTPMiddleware also run as async middleware
+
+Requests are fed to the ASGI application the same way uvicorn does (scope, receive, send),
+so the numbers match a `uvicorn portal.asgi:application` deployment.
+
+    python3 benchmark_middleware.py [requests]
+"""
+
+from asgiref.sync import SyncToAsync, AsyncToSync
+from time import perf_counter
+import asyncio
+import logging
+import os
+import sys
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from django.core.handlers.asgi import ASGIHandler
+from django.test import override_settings
+from django.conf import settings
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from inspect import iscoroutine
+from whitenoise.middleware import WhiteNoiseMiddleware
+from django_otp.middleware import OTPMiddleware
+from portal.middleware import ClearAuthenticationHeaderMiddleware
+
+
+class SyncOnlyClearAuthenticationHeaderMiddleware(ClearAuthenticationHeaderMiddleware):
+    async_capable = False
+
+
+class AsyncCapableMiddlewareMixin:
+    # For third-party middleware whose __call__ ends with `return self.get_response(request)`
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        response = super().__call__(request)
+        if iscoroutine(response):
+            response = await response
+        return response
+
+
+class AsyncWhiteNoiseMiddleware(AsyncCapableMiddlewareMixin, WhiteNoiseMiddleware):
+    pass
+
+
+class AsyncOTPMiddleware(AsyncCapableMiddlewareMixin, OTPMiddleware):
+    pass
+
+
+CONFIGURATIONS = {
+    "before": {
+        "portal.middleware.ClearAuthenticationHeaderMiddleware": f"{__name__}.SyncOnlyClearAuthenticationHeaderMiddleware",
+    },
+    "after": {},
+    "async-stack": {
+        "whitenoise.middleware.WhiteNoiseMiddleware": f"{__name__}.AsyncWhiteNoiseMiddleware",
+        "django_otp.middleware.OTPMiddleware": f"{__name__}.AsyncOTPMiddleware",
+    },
+}
+PATHS = ["/api/error/401/benchmark/", "/api/v1/chat/room-list/"]
+thread_hops = {"sync_to_async": 0, "async_to_sync": 0}
+
+
+def count_thread_hops(hop_class, name):
+    call = hop_class.__call__
+
+    def counted_call(self, *args, **kwargs):
+        thread_hops[name] += 1
+        return call(self, *args, **kwargs)
+
+    hop_class.__call__ = counted_call
+
+
+async def send_request(application, path):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", settings.ALLOWED_HOSTS[0].encode())],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        pass
+
+    await application(scope, receive, send)
+
+
+async def run_benchmark(label, replacements, requests):
+    middleware = [replacements.get(path, path) for path in settings.MIDDLEWARE]
+    with override_settings(MIDDLEWARE=middleware):
+        application = ASGIHandler()
+
+    for path in PATHS:
+        await send_request(application, path)
+
+    thread_hops.update(sync_to_async=0, async_to_sync=0)
+    start = perf_counter()
+    for index in range(requests):
+        await send_request(application, PATHS[index % len(PATHS)])
+    elapsed = perf_counter() - start
+
+    print(
+        f"{label:<12} sync_to_async/request: {thread_hops['sync_to_async'] / requests:.2f}  "
+        f"async_to_sync/request: {thread_hops['async_to_sync'] / requests:.2f}  "
+        f"ms/request: {elapsed * 1000 / requests:.3f}"
+    )
+
+
+async def main(requests):
+    for label, replacements in CONFIGURATIONS.items():
+        await run_benchmark(label, replacements, requests)
+
+
+if __name__ == "__main__":
+    logging.getLogger("django.request").setLevel(logging.ERROR)
+    count_thread_hops(SyncToAsync, "sync_to_async")
+    count_thread_hops(AsyncToSync, "async_to_sync")
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
@@ -1,6 +1,6 @@
 from django.contrib.admin import register, ModelAdmin, StackedInline
 
-from .models import Room, Message
+from .models import Room, Message, MediaUpload, MediaBlob
 
 
 @register(Room)
@@ -19,13 +19,28 @@ class MessageAdmin(ModelAdmin):
         "image_content",
         "audio_content",
         "video_content",
+        "media_blob",
         "is_reply",
         "previous_message_content",
         "previous_message_id",
         "previous_sender",
+        "previous_sender_username",
+        "previous_message_format",
         "sender",
         "room",
         "created",
         "updated",
     ]
-    list_filter = ["id", "sender", "created", "updated"]
\ No newline at end of file
+    list_filter = ["id", "sender", "created", "updated"]
+
+
+@register(MediaUpload)
+class MediaUploadAdmin(ModelAdmin):
+    list_display = ["id", "media_format", "size", "filename", "user", "room", "created"]
+    list_filter = ["created"]
+
+
+@register(MediaBlob)
+class MediaBlobAdmin(ModelAdmin):
+    list_display = ["id", "media_format", "file", "size", "width", "height", "ref_count", "created"]
+    list_filter = ["media_format", "created"]
@@ -3,13 +3,30 @@ from .utils import (
     RoomDetail,
     confirm_authorization,
     check_user_in_room,
-    set_user_status,
     ConsumerMessage,
     generate_random_filename,
+    get_inline_media,
+    encode_media_frame,
+    encode_room_notification,
+    build_frame_event,
+    encode_frame,
+    validate_media,
 )
+from django.conf import settings
 import json
 from django.utils.dateformat import format
-from base64 import b64encode
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from .uploads import ChunkedUpload
+from .serializers import encode_media_blob
+from .presence import presence_tracker
+from .typing_status import typing_tracker
+import asyncio
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
 
 
 class RoomConsumer(AsyncWebsocketConsumer):
@@ -21,40 +38,47 @@ class RoomConsumer(AsyncWebsocketConsumer):
         self.user = None
         self.room_instance = None
         self.consumer_message_instance = None
+        self.inline_media = False
+        self.upload_instance = None
+        self.is_room_joined = False
+        self.pending_notifications = {}
+        self.notification_task = None
         
     async def connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
+        query_params = parse_qs(self.scope.get("query_string", b"").decode("utf-8"))
+        self.inline_media = query_params.get("media", [None])[0] == "inline"
         self.room_instance = RoomDetail(self.room_id)
         self.room = await self.room_instance.retrieve_room_object()
         self.room_group_name = self.room_id
         
         headers = dict(self.scope["headers"])
         self.user = await confirm_authorization(headers)
+        self.upload_instance = ChunkedUpload(self.room, self.user)
         
-        user_in_room = await check_user_in_room(self.user.id, self.room_id)
+        user_in_room = self.user and await check_user_in_room(self.user.id, self.room_id)
         if not user_in_room:
             await self.close(code=4001)
+            return
         
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
-        
-        await set_user_status(self.user)
-        active_count = await self.room_instance.get_active_users_count()
-        await self.channel_layer.group_send(
-            self.room_group_name, {"type": "chat.active", "content": active_count}
-        )
+        self.is_room_joined = True
+        await presence_tracker.connect(self.channel_name, self.room_id, self.user.id)
         
     async def disconnect(self, code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-        await set_user_status(self.user, status="offline")
+        if not self.is_room_joined:
+            return
         
-        active_count = await self.room_instance.get_active_users_count()
-        await self.channel_layer.group_send(
-            self.room_group_name, {"type": "chat.active", "content": active_count}
-        )
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await presence_tracker.disconnect(self.channel_name)
+        await typing_tracker.stop(self.room_id, self.user.username)
+        if self.notification_task:
+            self.notification_task.cancel()
         
     async def receive(self, text_data=None, bytes_data=None):
         self.consumer_message_instance = ConsumerMessage(self.room)
+        await presence_tracker.heartbeat(self.channel_name, self.room_id, self.user.id)
         
         if text_data:
             text_data_json = json.loads(text_data)
@@ -67,7 +91,7 @@ class RoomConsumer(AsyncWebsocketConsumer):
                     
                     await self.channel_layer.group_send(
                         self.room_group_name,
-                        {
+                        build_frame_event({
                             "type": "chat.message",
                             "id": new_message_data["id"],
                             "text_content": message,
@@ -75,158 +99,268 @@ class RoomConsumer(AsyncWebsocketConsumer):
                             "username": self.user.username,
                             "created": new_message_data["date"],
                             "time": new_message_data["time"],
-                        },
+                        }),
                     )
             elif message_type == "reply":
                 previous_message_id = text_data_json.get("previous_message_id")
                 if message:
-                    replied_message = await self.consumer_message_instance.get_replied_message(previous_message_id)
-                    if replied_message["message_format"] == "IMG":
-                        previous_message_content = "IMAGE"
-                    elif replied_message["message_format"] == "AUD":
-                        previous_message_content = "AUDIO"
-                    elif replied_message["message_format"] == "VID":
-                        previous_message_content = "VIDEO"
-                    else:
-                        previous_message_content = replied_message["text_content"]
+                    reply_snapshot = await self.consumer_message_instance.get_reply_snapshot(previous_message_id)
+                    if not reply_snapshot:
+                        await self.chat_error({"type": "chat.error", "content": "Message with this id does not exist."})
+                        return
 
                     reply_id, created = await self.consumer_message_instance.create_new_reply(
                         self.user,
-                        replied_message["sender"],
-                        previous_message_content,
-                        previous_message_id,
+                        reply_snapshot,
                         message,
                     )
                     await self.channel_layer.group_send(
                         self.room_group_name,
-                        {
+                        build_frame_event({
                             "type": "chat.reply",
                             "is_reply": True,
                             "reply_format": "text",
                             "id": reply_id,
                             "text_content": message,
                             "message_format": "text",
-                            "previous_sender_username": replied_message["username"],
-                            "previous_message_content": previous_message_content,
+                            "previous_sender_username": reply_snapshot["previous_sender_username"],
+                            "previous_message_content": reply_snapshot["previous_message_content"],
                             "previous_message_id": previous_message_id,
                             "username": self.user.username,
                             "created": format(created, "M. d, Y"),
                             "time": format(created, "P"),
-                        },
+                        }),
                     )
             elif message_type == "typing":
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "chat.typing",
-                        "username": self.user.username,
-                        "content": (
-                            f"{self.user} is typing..." if message == "typing" else None
-                        ),
-                    },
-                )
+                await typing_tracker.update(self.room_id, self.user.username, message == "typing")
+            elif message_type == "upload.begin":
+                await self.begin_upload(text_data_json)
+            elif message_type == "upload.commit":
+                await self.commit_upload(text_data_json)
         elif bytes_data:
+            # Checked before anything is parsed or copied; larger media must use a chunked upload
+            if len(bytes_data) > settings.CHAT_MEDIA_FRAME_MAX_SIZE:
+                await self.chat_error({"type": "chat.error", "content": "Frame too large, use a chunked upload."})
+                return
+
             delimiter = b"<delimiter>"
+            delimiter_index = bytes_data.find(delimiter)
             
-            if delimiter in bytes_data:
-                json_data, media_data =  bytes_data.split(delimiter, 1)
-                if media_data == b"":
-                    await self.channel_layer.group_send(
-                        self.room_group_name, {"type": "chat.error", "content": "No file detected or invalid file data."}
-                    )
-                
-                metadata = json.loads(json_data.decode("utf-8"))
+            if delimiter_index != -1:
+                metadata = json.loads(bytes_data[:delimiter_index].decode("utf-8"))
+                media_data = memoryview(bytes_data)[delimiter_index + len(delimiter):]
                 message_type = metadata.get("message_type")
-                message_format = metadata.get("message_format")
+                if message_type == "upload.chunk":
+                    await self.receive_upload_chunk(metadata, media_data)
+                    return
+                
                 media_format = metadata.get("media_format")
+                if media_data:
+                    error = validate_media(media_format, len(media_data), media_data)
+                else:
+                    error = "No file detected or invalid file data."
+                if error:
+                    await self.chat_error({"type": "chat.error", "content": error})
+                    return
                 
-                message = b64encode(media_data).decode("utf-8")
                 filename = await generate_random_filename(media_format)
-                
-                if message_type == "media":
-                    new_media_message_id, created = await self.consumer_message_instance.create_new_media_message(media_format, self.user)
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "chat.media",
-                            "id": new_media_message_id,
-                            "content": message,
-                            "media_format": media_format,
-                            "message_format": "media",
-                            "filename": filename,
-                            "username": self.user.username,
-                            "created": format(created, "M. d, Y"),
-                            "time": format(created, "P"),
-                        },
-                    )
-                    
-                    await self.consumer_message_instance.update_media_message(new_media_message_id, message, filename, media_format)
-                else:
-                    previous_message_content = None
-                    previous_message_id = metadata.get("previous_message_id")
-                    replied_message = await self.consumer_message_instance.get_replied_message(previous_message_id)
-                    if replied_message["message_format"] == "IMG":
-                        previous_message_content = "IMAGE"
-                    elif replied_message["message_format"] == "AUD":
-                        previous_message_content = "AUDIO"
-                    elif replied_message["message_format"] == "VID":
-                        previous_message_content = "VIDEO"
-                    else:
-                        previous_message_content = replied_message["text_content"]
-
-                    new_media_reply_id, created = await self.consumer_message_instance.create_new_reply(
-                        self.user,
-                        replied_message["sender"],
-                        previous_message_content,
-                        previous_message_id,
-                        message_format=message_format,
-                    )
-                    
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "chat.reply",
-                            "is_reply": True,
-                            "reply_format": "media",
-                            "message_format": "media",
-                            "id": new_media_reply_id,
-                            "content": message,
-                            "media_format": media_format,
-                            "filename": filename,
-                            "previous_sender_username": replied_message["username"],
-                            "previous_message_content": previous_message_content,
-                            "previous_message_id": previous_message_id,
-                            "time": format(created, "P"),
-                            "created": format(created, "M. d, Y"),
-                            "username": self.user.username,
-                        },
-                    )
-                    await self.consumer_message_instance.update_media_message(new_media_reply_id, message, filename, media_format)
+                await self.send_media_message(
+                    media_data,
+                    filename,
+                    media_format,
+                    previous_message_id=metadata.get("previous_message_id"),
+                    is_reply=message_type != "media",
+                )
+
+    async def send_media_message(self, media_data, filename, media_format, previous_message_id=None, is_reply=False):
+        if not is_reply:
+            media_blob = await self.consumer_message_instance.store_media_file(media_data, filename, media_format)
+            # The stored extension follows the detected format, not the one the client claimed
+            filename = f"{os.path.splitext(filename)[0]}{os.path.splitext(media_blob.file.name)[1]}"
+            new_media_message_id, created = await self.consumer_message_instance.create_new_media_message(
+                self.user, media_blob
+            )
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                build_frame_event({
+                    "type": "chat.media",
+                    "id": new_media_message_id,
+                    "media_url": media_blob.file.url,
+                    **encode_media_blob(media_blob),
+                    "media_format": media_format,
+                    "message_format": "media",
+                    "filename": filename,
+                    "username": self.user.username,
+                    "created": format(created, "M. d, Y"),
+                    "time": format(created, "P"),
+                }, "id", "media_url", "media_format"),
+            )
+        else:
+            reply_snapshot = await self.consumer_message_instance.get_reply_snapshot(previous_message_id)
+            if not reply_snapshot:
+                await self.chat_error({"type": "chat.error", "content": "Message with this id does not exist."})
+                return False
+
+            media_blob = await self.consumer_message_instance.store_media_file(media_data, filename, media_format)
+            # The stored extension follows the detected format, not the one the client claimed
+            filename = f"{os.path.splitext(filename)[0]}{os.path.splitext(media_blob.file.name)[1]}"
+            new_media_reply_id, created = await self.consumer_message_instance.create_new_reply(
+                self.user, reply_snapshot, media_blob=media_blob
+            )
+            
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                build_frame_event({
+                    "type": "chat.reply",
+                    "is_reply": True,
+                    "reply_format": "media",
+                    "message_format": "media",
+                    "id": new_media_reply_id,
+                    "media_url": media_blob.file.url,
+                    **encode_media_blob(media_blob),
+                    "media_format": media_format,
+                    "filename": filename,
+                    "previous_sender_username": reply_snapshot["previous_sender_username"],
+                    "previous_message_content": reply_snapshot["previous_message_content"],
+                    "previous_message_id": previous_message_id,
+                    "time": format(created, "P"),
+                    "created": format(created, "M. d, Y"),
+                    "username": self.user.username,
+                }, "id", "media_url", "media_format"),
+            )
+        return True
+
+    async def begin_upload(self, data):
+        media_format = data.get("media_format")
+        size = data.get("size")
+        if not isinstance(size, int) or size <= 0:
+            await self.chat_error({"type": "chat.error", "content": "Invalid upload metadata."})
+            return
+        # Rejected from the declared size, before any chunk is accepted
+        error = validate_media(media_format, size)
+        if error:
+            await self.chat_error({"type": "chat.error", "content": error})
+            return
+        
+        filename = await generate_random_filename(media_format)
+        upload, offset = await self.upload_instance.begin(
+            media_format,
+            size,
+            filename,
+            upload_id=data.get("upload_id"),
+            previous_message_id=data.get("previous_message_id"),
+        )
+        if not upload:
+            await self.chat_error({"type": "chat.error", "content": "Too many unfinished uploads."})
+            return
+        await self.send_upload_status(upload, offset)
+
+    async def receive_upload_chunk(self, metadata, chunk):
+        upload = await self.upload_instance.get_upload(metadata.get("upload_id"))
+        if not upload:
+            await self.chat_error({"type": "chat.error", "content": "Upload with this id does not exist."})
+            return
+        
+        if metadata.get("offset") == 0:
+            error = validate_media(upload.media_format, upload.size, chunk)
+            if error:
+                upload_id = upload.id
+                await self.upload_instance.discard(upload)
+                await self.chat_error({"type": "chat.error", "content": error, "upload_id": upload_id})
+                return
+        
+        offset = await self.upload_instance.write_chunk(upload, metadata.get("offset"), chunk)
+        await self.send_upload_status(upload, offset)
+
+    async def commit_upload(self, data):
+        upload = await self.upload_instance.get_upload(data.get("upload_id"))
+        if not upload:
+            await self.chat_error({"type": "chat.error", "content": "Upload with this id does not exist."})
+            return
+        
+        offset = await self.upload_instance.get_offset(upload)
+        if offset != upload.size:
+            await self.chat_error({"type": "chat.error", "content": "Upload is incomplete."})
+            await self.send_upload_status(upload, offset)
+            return
+        
+        file_data = await sync_to_async(self.upload_instance.open_partial_file)(upload)
+        try:
+            is_sent = await self.send_media_message(
+                file_data,
+                upload.filename,
+                upload.media_format,
+                previous_message_id=upload.previous_message_id,
+                is_reply=bool(upload.previous_message_id),
+            )
+        except Exception:
+            # Dropped rather than retried: the same bytes would fail the same way
+            logger.exception("Failed to store upload %s", upload.id)
+            file_data.close()
+            upload_id = upload.id
+            await self.upload_instance.discard(upload)
+            await self.chat_error({"type": "chat.error", "content": "Upload could not be stored.", "upload_id": upload_id})
+            return
+        if is_sent:
+            await self.upload_instance.complete(upload)
+        else:
+            file_data.close()
+
+    async def send_upload_status(self, upload, offset):
+        await self.send(
+            encode_frame({"type": "chat.upload", "upload_id": upload.id, "offset": offset, "size": upload.size})
+        )
+
+    async def send_inline_media(self, event):
+        if self.inline_media and event.get("media_url"):
+            media_data = await get_inline_media(event["media_url"])
+            await self.send(
+                bytes_data=encode_media_frame({"id": event["id"], "media_format": event["media_format"]}, media_data)
+            )
+
+    async def send_event(self, event):
+        # Group events carry the frame the sender encoded once; it is forwarded as is
+        await self.send(event["frame"] if "frame" in event else encode_frame(event))
 
     async def chat_active(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+        await self.send_event(event)
         
     async def chat_notification(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+        # Notifications arriving within CHAT_NOTIFICATION_DELAY are merged into one frame per action
+        pending_notification = self.pending_notifications.setdefault(event["action"], {"usernames": [], "count": 0})
+        usernames_limit = settings.CHAT_NOTIFICATION_USERNAMES_LIMIT
+        pending_notification["usernames"].extend(
+            event["usernames"][:usernames_limit - len(pending_notification["usernames"])]
+        )
+        pending_notification["count"] += event["count"]
+        if not self.notification_task or self.notification_task.done():
+            self.notification_task = asyncio.create_task(self.send_notifications_later())
+
+    async def send_notifications_later(self):
+        # Notifications that arrive while earlier ones are being sent get another round
+        while self.pending_notifications:
+            await asyncio.sleep(settings.CHAT_NOTIFICATION_DELAY)
+            pending_notifications, self.pending_notifications = self.pending_notifications, {}
+            for action, pending_notification in pending_notifications.items():
+                await self.send(
+                    encode_room_notification(
+                        action, tuple(pending_notification["usernames"]), pending_notification["count"]
+                    )
+                )
         
     async def chat_message(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+        await self.send_event(event)
         
     async def chat_reply(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+        await self.send_event(event)
+        await self.send_inline_media(event)
         
     async def chat_media(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+        await self.send_event(event)
+        await self.send_inline_media(event)
         
     async def chat_typing(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+        await self.send_event(event)
         
     async def chat_error(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)    
\ No newline at end of file
+        await self.send_event(event)    
\ No newline at end of file
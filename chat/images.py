@@ -0,0 +1,56 @@
+from PIL import Image, ImageOps
+from io import BytesIO
+import base64
+import mimetypes
+
+# Runs in the image process pool, so nothing here may touch Django
+
+EXIF_ORIENTATION = 0x0112
+# Formats re-encoded without their metadata; others (e.g. animated GIF/WebP) are stored as uploaded
+STRIPPED_FORMATS = {"JPEG": {"quality": "keep"}, "PNG": {}}
+
+
+def build_image_derivatives(source, thumbnail_size, placeholder_size):
+    """
+    Detects the real format of an uploaded image (`source` is a path or bytes) and returns
+    its dimensions, a copy without EXIF/metadata, a WebP thumbnail no larger than
+    `thumbnail_size` and a tiny data-URI placeholder. Returns None if it is not an image
+    or cannot be decoded, in which case the file is stored as uploaded.
+    """
+    try:
+        with Image.open(source if isinstance(source, str) else BytesIO(source)) as image:
+            image_format = image.format
+            is_rotated = image.getexif().get(EXIF_ORIENTATION, 1) != 1
+            oriented_image = ImageOps.exif_transpose(image) if is_rotated else image
+
+            data = None
+            if image_format in STRIPPED_FORMATS and not getattr(image, "is_animated", False):
+                save_kwargs = {} if is_rotated else STRIPPED_FORMATS[image_format]
+                buffer = BytesIO()
+                oriented_image.save(
+                    buffer, format=image_format, icc_profile=image.info.get("icc_profile"), **save_kwargs
+                )
+                data = buffer.getvalue()
+
+            thumbnail = oriented_image.convert("RGBA" if oriented_image.has_transparency_data else "RGB")
+            thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+            thumbnail_buffer = BytesIO()
+            thumbnail.save(thumbnail_buffer, format="WEBP", quality=80)
+
+            thumbnail.thumbnail((placeholder_size, placeholder_size))
+            placeholder_buffer = BytesIO()
+            thumbnail.save(placeholder_buffer, format="WEBP", quality=30)
+
+            width, height = oriented_image.size
+    except Exception:
+        # Corrupt or hostile files make Pillow raise more than OSError (SyntaxError, struct.error, ...)
+        return None
+
+    return {
+        "extension": mimetypes.guess_extension(Image.MIME.get(image_format, "")) or f".{image_format.lower()}",
+        "data": data,
+        "width": width,
+        "height": height,
+        "thumbnail": thumbnail_buffer.getvalue(),
+        "placeholder": f"data:image/webp;base64,{base64.b64encode(placeholder_buffer.getvalue()).decode()}",
+    }
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from asgiref.sync import async_to_sync
+from chat.models import Message
+from chat.media import media_store
+from chat.utils import MEDIA_MESSAGE_FORMATS, MessageFormat
+import os
+
+
+class Command(BaseCommand):
+    help = "Move media stored before content addressing into MediaBlobs so it can be served and released."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        media_formats = {message_format: media_format for media_format, message_format in MEDIA_MESSAGE_FORMATS.items()}
+        messages = Message.objects.filter(media_blob__isnull=True).exclude(message_format=MessageFormat.TEXT)
+        backfilled_count = missing_count = 0
+        last_id = ""
+        while True:
+            batch = list(messages.filter(id__gt=last_id).order_by("id")[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            for message in batch:
+                media_format = media_formats[message.message_format]
+                media_field = getattr(message, f"{media_format}_content")
+                if not media_field or not media_field.storage.exists(media_field.name):
+                    missing_count += 1
+                    continue
+
+                legacy_name = media_field.name
+                with media_field.storage.open(legacy_name, "rb") as file:
+                    media_data = file.read()
+                # Stored (or deduplicated against an existing blob) exactly like a new upload
+                media_blob = async_to_sync(media_store.store)(media_data, os.path.basename(legacy_name), media_format)
+                message.media_blob = media_blob
+                setattr(message, f"{media_format}_content", media_blob.file.name)
+                message.save(update_fields=["media_blob", f"{media_format}_content"])
+                if legacy_name != media_blob.file.name:
+                    media_field.storage.delete(legacy_name)
+                backfilled_count += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Backfilled {backfilled_count} media messages ({missing_count} without a stored file).")
+        )
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from chat.models import Message
+from chat.utils import get_message_preview
+
+
+class Command(BaseCommand):
+    help = "Fill the denormalized parent snapshot on replies created before it was stored."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        replies = Message.objects.filter(is_reply=True, previous_sender_username__isnull=True).exclude(
+            previous_message_id__isnull=True
+        )
+        updated_count = 0
+        last_id = ""
+        while True:
+            batch = list(replies.filter(id__gt=last_id).order_by("id")[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            replied_messages = {
+                replied_message["id"]: replied_message
+                for replied_message in Message.objects.filter(
+                    id__in={reply.previous_message_id for reply in batch}
+                ).values("id", "sender_id", "sender__username", "message_format", "text_content")
+            }
+            updated_replies = []
+            for reply in batch:
+                replied_message = replied_messages.get(reply.previous_message_id)
+                if not replied_message:
+                    continue
+                reply.previous_sender = replied_message["sender_id"]
+                reply.previous_sender_username = replied_message["sender__username"]
+                reply.previous_message_format = replied_message["message_format"]
+                reply.previous_message_content = get_message_preview(
+                    replied_message["message_format"], replied_message["text_content"]
+                )
+                updated_replies.append(reply)
+
+            Message.objects.bulk_update(
+                updated_replies,
+                ["previous_sender", "previous_sender_username", "previous_message_format", "previous_message_content"],
+            )
+            updated_count += len(updated_replies)
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {updated_count} reply snapshots."))
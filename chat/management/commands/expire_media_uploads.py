@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from chat.uploads import expire_uploads
+from time import sleep
+
+
+class Command(BaseCommand):
+    help = "Delete chunked media uploads that were not committed within CHAT_UPLOAD_EXPIRY, with their partial files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Delete the expired uploads and exit.")
+        parser.add_argument("--poll-interval", type=float, default=settings.CHAT_UPLOAD_SWEEP_INTERVAL)
+
+    def handle(self, *args, **options):
+        while True:
+            expired_count = expire_uploads()
+            if expired_count:
+                self.stdout.write(f"Deleted {expired_count} expired uploads.")
+            if options["once"]:
+                break
+            sleep(options["poll_interval"])
@@ -0,0 +1,185 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha256
+from .images import build_image_derivatives
+import asyncio
+import atexit
+import os
+
+
+class ImageProcessor:
+    """
+    Runs `build_image_derivatives` in a pool of `processes` worker processes (started on
+    first use) so decoding and resizing neither blocks the event loop nor holds the GIL.
+    With `processes=0` the work runs in the default thread pool instead. If a worker dies
+    (e.g. killed while decoding a huge image) the image is stored without derivatives and
+    a fresh pool is started for the next one.
+    """
+
+    def __init__(self, processes=2, thumbnail_size=320, placeholder_size=16):
+        self.processes = processes
+        self.thumbnail_size = thumbnail_size
+        self.placeholder_size = placeholder_size
+        self.pool = None
+        # Daphne sends no lifespan events, so the workers are also stopped at interpreter exit
+        atexit.register(self.shutdown)
+
+    def get_pool(self):
+        if self.processes and self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.processes)
+        return self.pool
+
+    async def process(self, source):
+        pool = self.get_pool()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, build_image_derivatives, source, self.thumbnail_size, self.placeholder_size
+            )
+        except BrokenProcessPool:
+            if self.pool is pool:
+                self.shutdown()
+            return None
+
+    def shutdown(self):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class MediaStore:
+    """
+    Content-addressed storage for chat media. Files are named after the SHA-256 of
+    the uploaded bytes, so identical uploads (a meme forwarded to many rooms) are
+    stored and processed once and shared through a MediaBlob. Each blob counts the
+    messages pointing at it and its files are deleted together with the last of them.
+    """
+
+    def __init__(self, image_processor):
+        from .models import MediaBlob, Message
+
+        self.blob_model = MediaBlob
+        self.message_model = Message
+        self.image_processor = image_processor
+
+    @staticmethod
+    def get_digest(file_data):
+        digest = sha256()
+        for chunk in file_data.chunks():
+            digest.update(chunk)
+        file_data.seek(0)
+        return digest.hexdigest()
+
+    def get_storage_name(self, digest, filename, media_format):
+        # e.g. images/3f/3f9a...e1.png, sharded by the first byte of the digest
+        media_field = self.message_model._meta.get_field(f"{media_format}_content")
+        extension = os.path.splitext(filename)[1].lower()
+        return media_field.generate_filename(None, f"{digest[:2]}/{digest}{extension}")
+
+    def acquire(self, digest):
+        if self.blob_model.objects.filter(id=digest).update(ref_count=F("ref_count") + 1):
+            return self.blob_model.objects.get(id=digest)
+        return None
+
+    def find(self, file_data):
+        digest = self.get_digest(file_data)
+        return digest, self.acquire(digest)
+
+    async def store(self, media_data, filename, media_format):
+        if isinstance(media_data, File):
+            file_data = media_data
+        else:
+            file_data = SimpleUploadedFile(name=filename, content=media_data)
+
+        digest, media_blob = await sync_to_async(self.find)(file_data)
+        if media_blob:
+            await sync_to_async(file_data.close)()
+            return media_blob
+
+        image = None
+        if media_format == "image":
+            # Finished chunked uploads are read by the worker from disk rather than pickled across
+            if hasattr(file_data, "temporary_file_path"):
+                image = await self.image_processor.process(file_data.temporary_file_path())
+            else:
+                image = await self.image_processor.process(bytes(media_data))
+        return await sync_to_async(self.create)(digest, file_data, filename, media_format, image)
+
+    def create(self, digest, file_data, filename, media_format, image=None):
+        media_blob = self.blob_model(id=digest, media_format=media_format, ref_count=1)
+        with file_data:
+            stored_data = file_data
+            if image:
+                filename = f"{os.path.splitext(filename)[0]}{image['extension']}"
+                if image["data"] is not None:
+                    stored_data = ContentFile(image["data"])
+                media_blob.width, media_blob.height = image["width"], image["height"]
+                media_blob.placeholder = image["placeholder"]
+                media_blob.thumbnail.save(f"{digest[:2]}/{digest}.webp", ContentFile(image["thumbnail"]), save=False)
+            media_blob.size = stored_data.size
+            media_blob.file.save(self.get_storage_name(digest, filename, media_format), stored_data, save=False)
+
+        try:
+            with transaction.atomic():
+                media_blob.save(force_insert=True)
+        except IntegrityError:
+            # A concurrent upload of the same bytes stored it first; share that copy instead
+            self.delete_files(media_blob)
+            media_blob = self.acquire(digest)
+        return media_blob
+
+    @staticmethod
+    def delete_files(media_blob):
+        media_blob.file.delete(save=False)
+        if media_blob.thumbnail:
+            media_blob.thumbnail.delete(save=False)
+
+    def release(self, digest):
+        self.blob_model.objects.filter(id=digest, ref_count__gt=0).update(ref_count=F("ref_count") - 1)
+        media_blob = self.blob_model.objects.filter(id=digest, ref_count=0).first()
+        if media_blob and self.blob_model.objects.filter(id=digest, ref_count=0).delete()[0]:
+            transaction.on_commit(lambda: self.delete_files(media_blob))
+
+
+class MediaRange:
+    """Read-only view of bytes `start`..`end` (inclusive) of an open file, for 206 responses."""
+
+    def __init__(self, file, start, end):
+        file.seek(start)
+        self.file = file
+        self.remaining = end - start + 1
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+async def stream_media_file(file, block_size):
+    # Under ASGI each block is read in a worker thread so the event loop never blocks on disk I/O
+    # and the file is never held in memory whole (Django buffers synchronous iterators there)
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        while chunk := await read(block_size):
+            yield chunk
+    finally:
+        await sync_to_async(file.close, thread_sensitive=False)()
+
+
+image_processor = ImageProcessor(
+    processes=settings.CHAT_IMAGE_PROCESSES,
+    thumbnail_size=settings.CHAT_IMAGE_THUMBNAIL_SIZE,
+    placeholder_size=settings.CHAT_IMAGE_PLACEHOLDER_SIZE,
+)
+media_store = MediaStore(image_processor)
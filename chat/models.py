@@ -9,8 +9,13 @@ from django.db.models import (
     TextField,
     ImageField, 
     FileField,
-    BooleanField
+    BooleanField,
+    PositiveBigIntegerField,
+    PositiveIntegerField,
+    PROTECT,
+    Index,
 )
+from django.utils import timezone
 from nanoid import generate
 from .utils import generate_room_name, MessageFormat
 
@@ -36,6 +41,27 @@ class Room(Model):
         return super().save(*args, **kwargs)
 
 
+class MediaBlob(Model):
+    # Content-addressed: the id is the SHA-256 of the file, shared by every message that sends it
+    id = CharField(max_length=64, primary_key=True, editable=False)
+    media_format = CharField(max_length=10)
+    file = FileField(max_length=255, db_index=True)
+    size = PositiveBigIntegerField()
+    ref_count = PositiveIntegerField(default=0)
+    # Image previews, filled in by the ingest pipeline (chat.images)
+    width = PositiveIntegerField(blank=True, null=True)
+    height = PositiveIntegerField(blank=True, null=True)
+    thumbnail = FileField(upload_to="thumbnails/", max_length=255, blank=True, db_index=True)
+    placeholder = TextField(blank=True)
+    created = DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self):
+        return f"{self.media_format} {self.id}"
+
+
 class Message(Model):
     id = CharField(max_length=21, primary_key=True, editable=False, unique=True, default=generate)
     message_format = CharField(
@@ -45,17 +71,48 @@ class Message(Model):
     image_content = ImageField(upload_to="images/", blank=True)
     audio_content = FileField(upload_to="audios/", blank=True)
     video_content = FileField(upload_to="videos/", blank=True)
+    media_blob = ForeignKey(MediaBlob, related_name="messages", on_delete=PROTECT, blank=True, null=True)
     is_reply = BooleanField(default=False, db_index=True)
     previous_message_content = TextField(blank=True, null=True)
     previous_message_id = CharField(max_length=21, blank=True, null=True, db_index=True)
     previous_sender = CharField(max_length=50, blank=True, null=True)
+    previous_sender_username = CharField(max_length=120, blank=True, null=True, db_index=True)
+    previous_message_format = CharField(
+        max_length=3, choices=MessageFormat.choices, blank=True, null=True, db_index=True
+    )
     sender = ForeignKey(User, related_name="sent_messages", on_delete=CASCADE)
     room = ForeignKey(Room, related_name="messages", on_delete=CASCADE)
-    created = DateTimeField(auto_now_add=True, db_index=True)
+    # Set when the instance is built (not on INSERT) so write-behind broadcasts carry the stored timestamp
+    created = DateTimeField(default=timezone.now, editable=False, db_index=True)
     updated = DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ["-created"]
+        indexes = [
+            # Room history is read newest first in (created, id) keyset pages
+            Index(fields=["room", "-created", "-id"], name="chat_message_history_idx"),
+        ]
 
     def __str__(self):
         return f"{self.get_message_format_display()} message from {self.sender}"
+
+
+class MediaUpload(Model):
+    id = CharField(max_length=21, primary_key=True, editable=False, unique=True, default=generate)
+    media_format = CharField(max_length=10)
+    size = PositiveBigIntegerField()
+    filename = CharField(max_length=100)
+    previous_message_id = CharField(max_length=21, blank=True, null=True)
+    user = ForeignKey(User, related_name="media_uploads", on_delete=CASCADE)
+    room = ForeignKey(Room, related_name="media_uploads", on_delete=CASCADE)
+    created = DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self):
+        return f"{self.media_format} upload from {self.user}"
+
+    @property
+    def partial_name(self):
+        return f"{self.id}.part"
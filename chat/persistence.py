@@ -0,0 +1,155 @@
+from django.conf import settings
+from asgiref.sync import sync_to_async
+import asyncio
+import atexit
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Inserts new messages with a single INSERT each, or, when `batch_window` (seconds)
+    is set, collects the messages created within that window (up to `batch_size`)
+    and writes them with one bulk_create. Callers still await their own message.
+
+    With `write_behind` the caller does not wait at all: the message gets its id and
+    timestamp in-process and is returned straight away, and the queued rows are
+    written in the background. Rows still queued when the process dies are lost, so
+    the queue is flushed on ASGI lifespan shutdown and again at interpreter exit.
+
+    If the bulk INSERT fails, the batch is retried one row at a time, so a bad row
+    only loses itself and not the other messages (often from other rooms) with it.
+    """
+
+    def __init__(self, batch_window=0, batch_size=100, write_behind=False):
+        from .models import Message
+
+        self.message_model = Message
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.write_behind = write_behind
+        self.pending_messages = []
+        self.pending_futures = []
+        # Batches handed to bulk_create stay visible to get_pending until their INSERT commits
+        self.flushing_batches = []
+        self.flush_task = None
+        # The event loop only keeps weak references to tasks, so background flushes are held here
+        self.background_flushes = set()
+        if write_behind:
+            atexit.register(self.flush_sync)
+
+    def get_pending(self, message_id):
+        for messages in [self.pending_messages, *self.flushing_batches]:
+            for message in messages:
+                if message.id == message_id:
+                    return message
+        return None
+
+    async def create(self, **fields):
+        message = self.message_model(**fields)
+        if not self.batch_window and not self.write_behind:
+            try:
+                await message.asave(force_insert=True)
+            except Exception:
+                # The media reference was taken before the INSERT, so it is given back as for a failed batch
+                await sync_to_async(self.release_media)([message])
+                raise
+            return message
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending_messages.append(message)
+        self.pending_futures.append(future)
+        if len(self.pending_messages) >= self.batch_size:
+            if self.write_behind:
+                flush_task = loop.create_task(self.flush())
+                self.background_flushes.add(flush_task)
+                flush_task.add_done_callback(self.background_flushes.discard)
+            else:
+                await self.flush()
+        elif self.flush_task is None or self.flush_task.done() or self.flush_task.get_loop() is not loop:
+            self.flush_task = loop.create_task(self.flush_later())
+
+        if not self.write_behind:
+            await future
+        return message
+
+    async def flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        await self.flush()
+
+    async def flush(self):
+        messages, self.pending_messages = self.pending_messages, []
+        futures, self.pending_futures = self.pending_futures, []
+        if not messages:
+            return
+        self.flushing_batches.append(messages)
+        try:
+            await self.message_model.objects.abulk_create(messages)
+        except Exception:
+            await self.create_each(messages, futures)
+        else:
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            self.flushing_batches.remove(messages)
+
+    async def create_each(self, messages, futures):
+        failed_messages = []
+        for message, future in zip(messages, futures):
+            try:
+                await message.asave(force_insert=True)
+            except Exception as e:
+                if self.write_behind:
+                    logger.exception("Dropped queued message %s", message.id)
+                failed_messages.append(message)
+                if not future.done():
+                    future.set_exception(e)
+                    # Nobody awaits write-behind futures, so mark the exception as retrieved
+                    future.exception()
+            else:
+                if not future.done():
+                    future.set_result(None)
+
+        if failed_messages:
+            # The rows were never stored, so the media they took a reference on is given back
+            await sync_to_async(self.release_media)(failed_messages)
+
+    @staticmethod
+    def release_media(messages):
+        from .media import media_store
+
+        for message in messages:
+            if message.media_blob_id:
+                media_store.release(message.media_blob_id)
+
+    def flush_sync(self):
+        # Used at interpreter exit, when no event loop is left to run flush()
+        messages, self.pending_messages = self.pending_messages, []
+        self.pending_futures = []
+        if messages:
+            self.message_model.objects.bulk_create(messages)
+
+
+message_writer = MessageWriter(
+    batch_window=settings.CHAT_MESSAGE_BATCH_WINDOW,
+    batch_size=settings.CHAT_MESSAGE_BATCH_SIZE,
+    write_behind=settings.CHAT_MESSAGE_WRITE_BEHIND,
+)
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            from .media import image_processor
+
+            await message_writer.flush()
+            await sync_to_async(image_processor.shutdown)()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
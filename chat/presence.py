@@ -0,0 +1,182 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from channels.layers import get_channel_layer
+from collections import Counter, defaultdict
+from time import monotonic, time
+from uuid import uuid4
+from .utils import build_frame_event, get_shared_store, get_shared_key
+import asyncio
+
+
+User = get_user_model()
+
+
+class PresenceTracker:
+    """
+    Record of who is connected to which room, shared by all workers.
+
+    Each worker counts its own connections per (room, user) and only publishes the
+    transitions to the channel layer's shards: a room's sorted set holds one
+    "<user id>:<worker id>" member per user connected through a worker and a user's set
+    holds one member per worker they are connected through. Members are scored with an
+    expiry that live workers push forward every `timeout / 2`, so the entries of a worker
+    that died lapse on their own. The active count is the number of distinct users in the
+    room's set and a user is online while their set is not empty; status changes are
+    re-checked against it and written to User.is_online in batches after `persist_delay`,
+    and `chat.active` broadcasts are coalesced per room over `broadcast_delay`.
+    Connections that have not been seen for `timeout` seconds are expired.
+    """
+
+    def __init__(self, timeout=90, persist_delay=1.0, broadcast_delay=0.1):
+        self.timeout = timeout
+        self.persist_delay = persist_delay
+        self.broadcast_delay = broadcast_delay
+        self.worker_id = uuid4().hex
+        self.connections = {}
+        self.room_users = defaultdict(Counter)
+        self.user_connections = Counter()
+        self.pending_user_ids = set()
+        self.persist_task = None
+        self.broadcast_tasks = {}
+        self.expiry_task = None
+
+    # Shared state
+
+    @staticmethod
+    def get_key(kind, name):
+        return get_shared_key("presence", kind, name)
+
+    async def publish(self, key, member, is_present):
+        pipeline = get_shared_store(key).pipeline(transaction=False)
+        if is_present:
+            pipeline.zadd(key, {member: time() + self.timeout})
+            pipeline.expire(key, int(self.timeout) + 1)
+        else:
+            pipeline.zrem(key, member)
+        await pipeline.execute()
+
+    async def get_members(self, key):
+        store = get_shared_store(key)
+        await store.zremrangebyscore(key, 0, time())
+        return await store.zrange(key, 0, -1)
+
+    async def get_active_count(self, room_id):
+        members = await self.get_members(self.get_key("room", room_id))
+        return len({member.rpartition(b":")[0] for member in members})
+
+    async def is_online(self, user_id):
+        return bool(await self.get_members(self.get_key("user", user_id)))
+
+    # Connections
+
+    async def connect(self, channel_name, room_id, user_id):
+        self.connections[channel_name] = [room_id, user_id, monotonic()]
+        self.room_users[room_id][user_id] += 1
+        self.user_connections[user_id] += 1
+        if self.room_users[room_id][user_id] == 1:
+            await self.publish(self.get_key("room", room_id), f"{user_id}:{self.worker_id}", True)
+        if self.user_connections[user_id] == 1:
+            await self.publish(self.get_key("user", user_id), self.worker_id, True)
+            self.set_status(user_id)
+        self.schedule_broadcast(room_id)
+        self.schedule_expiry()
+
+    async def disconnect(self, channel_name):
+        connection = self.connections.pop(channel_name, None)
+        if not connection:
+            return
+        room_id, user_id, last_seen = connection
+
+        self.room_users[room_id][user_id] -= 1
+        if self.room_users[room_id][user_id] <= 0:
+            del self.room_users[room_id][user_id]
+            await self.publish(self.get_key("room", room_id), f"{user_id}:{self.worker_id}", False)
+        if not self.room_users[room_id]:
+            del self.room_users[room_id]
+
+        self.user_connections[user_id] -= 1
+        if self.user_connections[user_id] <= 0:
+            del self.user_connections[user_id]
+            await self.publish(self.get_key("user", user_id), self.worker_id, False)
+            self.set_status(user_id)
+        self.schedule_broadcast(room_id)
+
+    async def heartbeat(self, channel_name, room_id, user_id):
+        if channel_name in self.connections:
+            self.connections[channel_name][2] = monotonic()
+        else:
+            await self.connect(channel_name, room_id, user_id)
+
+    async def expire(self):
+        deadline = monotonic() - self.timeout
+        for channel_name, (room_id, user_id, last_seen) in list(self.connections.items()):
+            if last_seen < deadline:
+                await self.disconnect(channel_name)
+
+    async def refresh(self):
+        # Pushes the expiry of this worker's shared entries forward
+        entries = [
+            (self.get_key("room", room_id), f"{user_id}:{self.worker_id}")
+            for room_id, users in self.room_users.items() for user_id in users
+        ]
+        entries += [(self.get_key("user", user_id), self.worker_id) for user_id in self.user_connections]
+        await asyncio.gather(*(self.publish(key, member, True) for key, member in entries))
+
+    # Background work is scheduled on the running loop; tasks from a loop that has since
+    # closed (e.g. between tests) are simply replaced.
+
+    @staticmethod
+    def is_scheduled(task):
+        return task is not None and not task.done() and not task.get_loop().is_closed()
+
+    def set_status(self, user_id):
+        self.pending_user_ids.add(user_id)
+        if not self.is_scheduled(self.persist_task):
+            self.persist_task = asyncio.get_running_loop().create_task(self.persist_later())
+
+    async def persist_later(self):
+        await asyncio.sleep(self.persist_delay)
+        await self.persist()
+
+    async def persist(self):
+        # The status written is read from the shared sets, so a worker that saw a user's last
+        # local connection close does not mark them offline while another worker still has one
+        pending_user_ids, self.pending_user_ids = list(self.pending_user_ids), set()
+        statuses = await asyncio.gather(*(self.is_online(user_id) for user_id in pending_user_ids))
+        for is_online in [True, False]:
+            user_ids = [user_id for user_id, status in zip(pending_user_ids, statuses) if status == is_online]
+            if user_ids:
+                await User.objects.filter(id__in=user_ids).aupdate(is_online=is_online)
+
+    async def flush(self):
+        if self.is_scheduled(self.persist_task) and self.persist_task is not asyncio.current_task():
+            self.persist_task.cancel()
+        await self.persist()
+
+    def schedule_broadcast(self, room_id):
+        if not self.is_scheduled(self.broadcast_tasks.get(room_id)):
+            self.broadcast_tasks[room_id] = asyncio.get_running_loop().create_task(self.broadcast_later(room_id))
+
+    async def broadcast_later(self, room_id):
+        await asyncio.sleep(self.broadcast_delay)
+        self.broadcast_tasks.pop(room_id, None)
+        await get_channel_layer().group_send(
+            room_id, build_frame_event({"type": "chat.active", "content": await self.get_active_count(room_id)})
+        )
+
+    def schedule_expiry(self):
+        if not self.is_scheduled(self.expiry_task):
+            self.expiry_task = asyncio.get_running_loop().create_task(self.expire_periodically())
+
+    async def expire_periodically(self):
+        while self.connections:
+            await asyncio.sleep(self.timeout / 2)
+            await self.expire()
+            await self.refresh()
+
+
+presence_tracker = PresenceTracker(
+    timeout=settings.CHAT_PRESENCE_TIMEOUT,
+    persist_delay=settings.CHAT_PRESENCE_PERSIST_DELAY,
+    broadcast_delay=settings.CHAT_PRESENCE_BROADCAST_DELAY,
+)
@@ -1,88 +1,67 @@
 from django.contrib.auth import get_user_model
-from rest_framework.serializers import ModelSerializer, SerializerMethodField, ListField
+from rest_framework.serializers import ModelSerializer, SerializerMethodField, ListField, CharField, IntegerField
 from rest_framework.exceptions import ValidationError
 from .models import Room, Message
 from django.utils.dateformat import format
-from asgiref.sync import sync_to_async
 
 
 User = get_user_model()
 
 
-class MessageSerializer(ModelSerializer):
-    sender = SerializerMethodField()
-    room = SerializerMethodField()
-    username = SerializerMethodField()
-    created = SerializerMethodField()
-    date = SerializerMethodField()
-    time = SerializerMethodField()
-    previous_sender_username = SerializerMethodField()
-    previous_message_type = SerializerMethodField()
+def encode_media_url(media_file):
+    return media_file.url if media_file else None
 
-    class Meta:
-        model = Message
-        fields = [
-            "id",
-            "message_format",
-            "text_content",
-            "image_content",
-            "audio_content",
-            "video_content",
-            "is_reply",
-            "previous_message_content",
-            "previous_message_type",
-            "previous_message_id",
-            "previous_sender_username",
-            "sender",
-            "room",
-            "created",
-            "date",
-            "time",
-            "username",
-        ]
-        read_only_fields = [
-            "id",
-            "sender",
-            "room",
-            "created",
-            "date",
-            "time"
-        ]
 
-    def get_sender(self, obj):
-        return obj.sender.id
+def encode_media_blob(media_blob):
+    # Clients render the placeholder, then the thumbnail, and only fetch media_url on demand
+    if not media_blob:
+        return {"media_hash": None, "width": None, "height": None, "thumbnail_url": None, "placeholder": None}
+    return {
+        "media_hash": media_blob.id,
+        "width": media_blob.width,
+        "height": media_blob.height,
+        "thumbnail_url": encode_media_url(media_blob.thumbnail),
+        "placeholder": media_blob.placeholder or None,
+    }
 
-    def get_room(self, obj):
-        return obj.room.id
-        
-    def get_username(self, obj):
-        return obj.sender.username
-    
-    def get_previous_sender_username(self, obj):
-        return User.objects.filter(id=obj.previous_sender).first().username if obj.previous_sender else None
-    
-    def get_previous_message_type(self, obj):
-        return Message.objects.filter(id=obj.previous_message_id).first().message_format if obj.previous_message_id else None
-    
-    def get_created(self, obj):
-        return format(obj.created, "M. d, Y. P")
-    
-    def get_date(self, obj):
-        return format(obj.created, "M. d, Y")
-    
-    def get_time(self, obj):
-        return format(obj.created, "P")
-    
-    
-class AsyncMessageSerializer(ModelSerializer):
-    sender = SerializerMethodField()
-    room = SerializerMethodField()
-    username = SerializerMethodField()
-    created = SerializerMethodField()
-    date = SerializerMethodField()
-    time = SerializerMethodField()
-    previous_sender_username = SerializerMethodField()
-    previous_message_type = SerializerMethodField()
+
+def encode_message(message):
+    # Shared by the REST serializer and the websocket consumer so both emit identical payloads
+    return {
+        "id": message.id,
+        "message_format": message.message_format,
+        "text_content": message.text_content,
+        "image_content": encode_media_url(message.image_content),
+        "audio_content": encode_media_url(message.audio_content),
+        "video_content": encode_media_url(message.video_content),
+        **encode_media_blob(message.media_blob),
+        "is_reply": message.is_reply,
+        "previous_message_content": message.previous_message_content,
+        "previous_message_type": message.previous_message_format,
+        "previous_message_id": message.previous_message_id,
+        "previous_sender_username": message.previous_sender_username,
+        "sender": message.sender_id,
+        "room": message.room_id,
+        "created": format(message.created, "M. d, Y. P"),
+        "date": format(message.created, "M. d, Y"),
+        "time": format(message.created, "P"),
+        "username": message.sender.username,
+    }
+
+
+class MessageSerializer(ModelSerializer):
+    sender = CharField(source="sender_id", read_only=True)
+    room = CharField(source="room_id", read_only=True)
+    username = CharField(read_only=True)
+    created = CharField(read_only=True)
+    date = CharField(read_only=True)
+    time = CharField(read_only=True)
+    previous_message_type = CharField(source="previous_message_format", read_only=True, allow_null=True)
+    media_hash = CharField(source="media_blob_id", read_only=True, allow_null=True)
+    width = IntegerField(source="media_blob.width", read_only=True, allow_null=True)
+    height = IntegerField(source="media_blob.height", read_only=True, allow_null=True)
+    thumbnail_url = CharField(source="media_blob.thumbnail.url", read_only=True, allow_null=True)
+    placeholder = CharField(source="media_blob.placeholder", read_only=True, allow_null=True)
 
     class Meta:
         model = Message
@@ -93,6 +72,11 @@ class AsyncMessageSerializer(ModelSerializer):
             "image_content",
             "audio_content",
             "video_content",
+            "media_hash",
+            "width",
+            "height",
+            "thumbnail_url",
+            "placeholder",
             "is_reply",
             "previous_message_content",
             "previous_message_type",
@@ -114,37 +98,8 @@ class AsyncMessageSerializer(ModelSerializer):
             "time"
         ]
 
-    @sync_to_async
-    def get_sender(self, obj):
-        return obj.sender.id
-
-    @sync_to_async
-    def get_room(self, obj):
-        return obj.room.id
-        
-    @sync_to_async
-    def get_username(self, obj):
-        return obj.sender.username
-    
-    @sync_to_async
-    def get_previous_sender_username(self, obj):
-        return User.objects.filter(id=obj.previous_sender).first().username if obj.previous_sender else None
-    
-    @sync_to_async
-    def get_previous_message_type(self, obj):
-        return Message.objects.filter(id=obj.previous_message_id).first().message_format if obj.previous_message_id else None
-    
-    @sync_to_async
-    def get_created(self, obj):
-        return format(obj.created, "M. d, Y. P")
-    
-    @sync_to_async
-    def get_date(self, obj):
-        return format(obj.created, "M. d, Y")
-    
-    @sync_to_async
-    def get_time(self, obj):
-        return format(obj.created, "P")
+    def to_representation(self, instance):
+        return encode_message(instance)
     
     
 class RoomSerializer(ModelSerializer):
@@ -163,15 +118,10 @@ class RoomSerializer(ModelSerializer):
         new_room = Room.objects.create(**validated_data)
 
         if users_data is not None:
-            for user_id in users_data:
-                user = User.objects.filter(id=user_id)
-                if all(
-                    [
-                        user.exists(),
-                        not Room.objects.filter(users__id=user_id).exists(),
-                    ]
-                ):
-                    new_room.users.add(user.first())
+            # Only existing users that are not yet in any room are added, validated in one query
+            # and inserted with one bulk add (a single m2m_changed signal)
+            user_ids = User.objects.filter(id__in=set(users_data), room__isnull=True).values_list("id", flat=True)
+            new_room.users.add(*user_ids)
         return new_room
 
     def get_users(self, obj):
@@ -1,32 +1,58 @@
 from django.dispatch import receiver
-from django.db.models.signals import m2m_changed
-from .models import Room
-from .utils import retrieve_user
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from .models import Room, Message
+from .media import media_store
+from .utils import forget_authorized_user, forget_room_membership, build_room_notification
+from user.models import JWTAccessToken
 from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.db.transaction import on_commit
 
 
+User = get_user_model()
 channel_layer = get_channel_layer()
 
+@receiver(post_save, sender=JWTAccessToken)
+def forget_rotated_access_token(sender, instance, created, **kwargs):
+    # A connect during the rotation would still read and re-cache the old token, so wait for the commit
+    if not created:
+        on_commit(lambda: forget_authorized_user(instance.user_id))
+
+
+@receiver(post_delete, sender=Message)
+def release_message_media(sender, instance, **kwargs):
+    if instance.media_blob_id:
+        media_store.release(instance.media_blob_id)
+
+
+@receiver(m2m_changed, sender=Room.users.through)
+def forget_changed_room_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ["post_add", "post_remove", "post_clear"]:
+        if reverse:
+            for room_id in pk_set or [None]:
+                forget_room_membership(user_id=instance.pk, room_id=room_id)
+        else:
+            for user_id in pk_set or [None]:
+                forget_room_membership(user_id=user_id, room_id=instance.pk)
+
+
 @receiver(m2m_changed, sender=Room.users.through)
-async def notify_new_room_user(sender, instance, action, pk_set, **kwargs):
-    if action == "post_add":
-        for user_id in pk_set:
-            user = await retrieve_user(user_id)
-            await channel_layer.group_send(
-                instance.id,
-                {
-                    "type": "chat.notification",
-                    "content": f"{user.username} joined the chat."
-                }
-            )
-            
-    elif action == "post_remove":
-        for user_id in pk_set:
-            user = await retrieve_user(user_id)
-            await channel_layer.group_send(
-                instance.id,
-                {
-                    "type": "chat.notification",
-                    "content": f"{user.username} left the chat."
-                }
-            )
\ No newline at end of file
+async def notify_new_room_user(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ["post_add", "post_remove"] or not pk_set:
+        return
+    
+    notification_action = "joined" if action == "post_add" else "left"
+    if reverse:
+        for room_id in pk_set:
+            await channel_layer.group_send(room_id, build_room_notification(notification_action, [instance.username], 1))
+        return
+    
+    usernames = [
+        username async for username in User.objects.filter(id__in=pk_set).order_by("username").values_list(
+            "username", flat=True
+        )[:settings.CHAT_NOTIFICATION_USERNAMES_LIMIT]
+    ]
+    await channel_layer.group_send(
+        instance.id, build_room_notification(notification_action, usernames, len(pk_set))
+    )
@@ -8,6 +8,25 @@ from .utils import (
     send_image_message,
     send_audio_message,
     send_reply_image_message,
+    generate_test_image,
+    generate_test_photo,
+    send_upload_begin,
+    send_upload_chunk,
+    send_upload_commit,
+    confirm_authorization,
+    check_user_in_room,
+    ConsumerMessage,
+    authorized_user_cache,
+    room_membership_cache,
+    encode_frame,
+    build_frame_event,
+    build_room_notification,
+    encode_room_notification,
+    encode_media_frame,
+    read_media_file,
+    inline_media_cache,
+    sniff_media_formats,
+    validate_media,
 )
 from channels.routing import URLRouter
 from django.urls import path
@@ -15,15 +34,40 @@ from .consumers import RoomConsumer
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
 import json
-from .models import Room
+from .models import Room, Message, MediaUpload, MediaBlob
 from user.models import JWTAccessToken
 from django.urls import reverse
 from user.utils import RefreshToken
+from django.test import override_settings, SimpleTestCase
+from tempfile import mkdtemp
+from asgiref.sync import async_to_sync, sync_to_async
+from .uploads import ChunkedUpload
+from .presence import PresenceTracker, presence_tracker
+from .typing_status import TypingTracker
+from .persistence import MessageWriter
+import asyncio
+from channels.layers import get_channel_layer
+from unittest.mock import patch, AsyncMock
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, IntegrityError, transaction
+from django.utils import timezone
+from .serializers import MessageSerializer, encode_message
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from io import StringIO, BytesIO
+from hashlib import sha256
+from PIL import Image
+from .images import build_image_derivatives
+from .media import ImageProcessor
+import os
+import gc
+from django.db.models.signals import m2m_changed
 
 
 User = get_user_model()
 
 
+@override_settings(MEDIA_ROOT=mkdtemp())
 class RoomConsumerTestCase(APITransactionTestCase):
     async def asyncSetUp(self):
         user_instance = TestUser(
@@ -68,8 +112,10 @@ class RoomConsumerTestCase(APITransactionTestCase):
         # Test adding new user to room
         await add_user_to_room(self.room, self.user2)
         
-        message2 = await communicator.receive_from()
-        self.assertEqual(message2, '{"type": "chat.notification", "content": "admin joined the chat."}')
+        message2 = json.loads(await communicator.receive_from())
+        self.assertEqual(message2["type"], "chat.notification")
+        self.assertEqual(message2["content"], "admin joined the chat.")
+        self.assertEqual(message2["usernames"], ["admin"])
         
         # Test sending number of active users
         communicator2 = WebsocketCommunicator(
@@ -111,6 +157,8 @@ class RoomConsumerTestCase(APITransactionTestCase):
         image_dict_message = json.loads(message7)
         self.assertEqual(image_dict_message["type"], "chat.media")
         self.assertEqual(image_dict_message["filename"].endswith("png"), True)
+        self.assertNotIn("content", image_dict_message)
+        self.assertTrue(image_dict_message["media_url"].endswith(f"{image_dict_message['media_hash']}.png"))
 
         # # Test send audio
         # await send_audio_message(communicator)
@@ -134,11 +182,13 @@ class RoomConsumerTestCase(APITransactionTestCase):
         
         # Test removing user from room
         await remove_user_from_room(self.room, self.user2)
-        message10 = await communicator.receive_from()
-        self.assertEqual(message10, '{"type": "chat.notification", "content": "admin left the chat."}')
+        message10 = json.loads(await communicator.receive_from())
+        self.assertEqual(message10["type"], "chat.notification")
+        self.assertEqual(message10["content"], "admin left the chat.")
         
         # Test websocket disconnection
         await communicator.disconnect()
+        await presence_tracker.flush()
         user = await User.objects.filter(id=self.user.id).afirst()
         self.assertFalse(user.is_online)
          
@@ -146,6 +196,807 @@ class RoomConsumerTestCase(APITransactionTestCase):
         return super().tearDown()
         
         
+@override_settings(MEDIA_ROOT=mkdtemp())
+class RoomConsumerInlineMediaTestCase(APITransactionTestCase):
+    async def asyncSetUp(self):
+        user_instance = TestUser(
+            email="admin@gmail.com",
+            is_email_verified=True,
+            is_2fa_enabled=True
+        )
+        self.user = await user_instance.create_user()
+        self.token = await user_instance.create_token()
+        
+        self.room = await user_instance.create_room(room_name="test")
+        await add_user_to_room(self.room, self.user)
+        self.application = URLRouter(
+            [path("testws/room/<str:room_id>/", RoomConsumer.as_asgi())]
+        )
+        self.url = f"/testws/room/{self.room.id}/"
+        
+    async def test_inline_media_passthrough_success(self):
+        await self.asyncSetUp()
+        communicator = WebsocketCommunicator(
+            self.application,
+            f"{self.url}?media=inline",
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_from()
+        
+        await send_image_message(communicator)
+        image_dict_message = json.loads(await communicator.receive_from())
+        self.assertEqual(image_dict_message["type"], "chat.media")
+        self.assertNotIn("content", image_dict_message)
+        
+        # Inline clients get the stored bytes as a binary frame after the event
+        media_frame = await communicator.receive_output()
+        metadata, media_data = media_frame["bytes"].split(b"<delimiter>", 1)
+        self.assertEqual(json.loads(metadata)["id"], image_dict_message["id"])
+        self.assertEqual(media_data, generate_test_image())
+        
+        await communicator.disconnect()
+
+    async def test_inline_media_read_once_per_broadcast_success(self):
+        await self.asyncSetUp()
+        inline_media_cache.clear()
+        communicators = []
+        for index in range(3):
+            communicator = WebsocketCommunicator(
+                self.application, f"{self.url}?media=inline", headers={"Authorization": f"Bearer {self.token}"}
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            communicators.append(communicator)
+        await asyncio.sleep(0.2)
+        for communicator in communicators:
+            while not await communicator.receive_nothing():
+                await communicator.receive_from()
+        
+        with patch("chat.utils.read_media_file", wraps=read_media_file) as read:
+            await send_image_message(communicators[0])
+            for communicator in communicators:
+                self.assertEqual(json.loads(await communicator.receive_from())["type"], "chat.media")
+                media_frame = await communicator.receive_output()
+                self.assertEqual(media_frame["bytes"].split(b"<delimiter>", 1)[1], generate_test_image())
+        self.assertEqual(read.call_count, 1)
+        
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_invalid_media_rejected_to_sender_only_failure(self):
+        await self.asyncSetUp()
+        communicators = []
+        for index in range(2):
+            communicator = WebsocketCommunicator(
+                self.application, self.url, headers={"Authorization": f"Bearer {self.token}"}
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_from()
+            communicators.append(communicator)
+        sender, other = communicators
+        # Let the coalesced chat.active broadcast for the second connection arrive first
+        await asyncio.sleep(0.2)
+        for communicator in communicators:
+            while not await communicator.receive_nothing():
+                await communicator.receive_from()
+        
+        await sender.send_to(bytes_data=encode_media_frame({"message_type": "media", "media_format": "image"}, b"MZ\x90\x00" * 8))
+        error = json.loads(await sender.receive_from())
+        self.assertEqual(error, {"type": "chat.error", "content": "File content is not a supported image format."})
+        
+        with override_settings(CHAT_MEDIA_FRAME_MAX_SIZE=64):
+            await send_image_message(sender)
+            error = json.loads(await sender.receive_from())
+        self.assertEqual(error["content"], "Frame too large, use a chunked upload.")
+        
+        self.assertTrue(await other.receive_nothing())
+        self.assertFalse(await Message.objects.aexists())
+        for communicator in communicators:
+            await communicator.disconnect()
+        
+        
+@override_settings(MEDIA_ROOT=mkdtemp(), CHAT_UPLOAD_ROOT=mkdtemp())
+class RoomConsumerChunkedUploadTestCase(APITransactionTestCase):
+    async def asyncSetUp(self):
+        user_instance = TestUser(
+            email="admin@gmail.com",
+            is_email_verified=True,
+            is_2fa_enabled=True
+        )
+        self.user = await user_instance.create_user()
+        self.token = await user_instance.create_token()
+        
+        self.room = await user_instance.create_room(room_name="test")
+        await add_user_to_room(self.room, self.user)
+        self.application = URLRouter(
+            [path("testws/room/<str:room_id>/", RoomConsumer.as_asgi())]
+        )
+        self.url = f"/testws/room/{self.room.id}/"
+        
+    async def connect(self):
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_from()
+        return communicator
+        
+    async def test_chunked_upload_resume_success(self):
+        await self.asyncSetUp()
+        image_data = generate_test_image(size=(256, 256))
+        chunk_size = len(image_data) // 3
+        
+        communicator = await self.connect()
+        status = await send_upload_begin(communicator, len(image_data))
+        self.assertEqual(status["type"], "chat.upload")
+        self.assertEqual(status["offset"], 0)
+        upload_id = status["upload_id"]
+        
+        status = await send_upload_chunk(communicator, upload_id, 0, image_data[:chunk_size])
+        self.assertEqual(status["offset"], chunk_size)
+        
+        # Chunks at the wrong offset are ignored and the client is resynced
+        status = await send_upload_chunk(communicator, upload_id, 0, image_data[:chunk_size])
+        self.assertEqual(status["offset"], chunk_size)
+        
+        # Committing early is rejected without broadcasting
+        await send_upload_commit(communicator, upload_id)
+        error = json.loads(await communicator.receive_from())
+        self.assertEqual(error["type"], "chat.error")
+        await communicator.receive_from()
+        await communicator.disconnect()
+        
+        # Resume on a fresh connection
+        communicator = await self.connect()
+        status = await send_upload_begin(communicator, len(image_data), upload_id=upload_id)
+        self.assertEqual(status["upload_id"], upload_id)
+        self.assertEqual(status["offset"], chunk_size)
+        
+        status = await send_upload_chunk(communicator, upload_id, chunk_size, image_data[chunk_size:])
+        self.assertEqual(status["offset"], len(image_data))
+        
+        await send_upload_commit(communicator, upload_id)
+        media_message = json.loads(await communicator.receive_from())
+        self.assertEqual(media_message["type"], "chat.media")
+        
+        message = await Message.objects.filter(id=media_message["id"]).afirst()
+        with message.image_content.open("rb") as file:
+            self.assertEqual(file.read(), image_data)
+        self.assertFalse(await MediaUpload.objects.filter(id=upload_id).aexists())
+        
+        await communicator.disconnect()
+
+    @override_settings(CHAT_UPLOAD_MAX_OPEN=2)
+    async def test_open_uploads_capped_success(self):
+        await self.asyncSetUp()
+        communicator = await self.connect()
+        for index in range(2):
+            status = await send_upload_begin(communicator, 1024)
+            self.assertEqual(status["type"], "chat.upload")
+        error = await send_upload_begin(communicator, 1024)
+        self.assertEqual(error, {"type": "chat.error", "content": "Too many unfinished uploads."})
+        
+        # Resuming an existing upload is still allowed
+        status = await send_upload_begin(communicator, 1024, upload_id=status["upload_id"])
+        self.assertEqual(status["type"], "chat.upload")
+        await communicator.disconnect()
+
+    async def test_abandoned_uploads_expire_success(self):
+        await self.asyncSetUp()
+        communicator = await self.connect()
+        status = await send_upload_begin(communicator, 1024)
+        await send_upload_chunk(communicator, status["upload_id"], 0, generate_test_image()[:100])
+        await communicator.disconnect()
+        
+        upload = await MediaUpload.objects.aget(id=status["upload_id"])
+        partial_path = ChunkedUpload.get_partial_path(upload)
+        self.assertTrue(os.path.exists(partial_path))
+        
+        await sync_to_async(call_command)("expire_media_uploads", "--once", stdout=StringIO())
+        self.assertTrue(await MediaUpload.objects.aexists())
+        with override_settings(CHAT_UPLOAD_EXPIRY=0):
+            await sync_to_async(call_command)("expire_media_uploads", "--once", stdout=StringIO())
+        self.assertFalse(await MediaUpload.objects.aexists())
+        self.assertFalse(os.path.exists(partial_path))
+
+    @override_settings(CHAT_MEDIA_MAX_SIZES={"image": 1024, "audio": 1024, "video": 1024})
+    async def test_upload_over_size_limit_failure(self):
+        await self.asyncSetUp()
+        communicator = await self.connect()
+        error = await send_upload_begin(communicator, 2048)
+        self.assertEqual(error["type"], "chat.error")
+        self.assertFalse(await MediaUpload.objects.aexists())
+        await communicator.disconnect()
+
+    async def test_upload_content_mismatch_failure(self):
+        await self.asyncSetUp()
+        communicator = await self.connect()
+        status = await send_upload_begin(communicator, 1024, media_format="video")
+        
+        # The first chunk is sniffed, and a PNG is not a video
+        error = await send_upload_chunk(communicator, status["upload_id"], 0, generate_test_image())
+        self.assertEqual(error["type"], "chat.error")
+        self.assertEqual(error["upload_id"], status["upload_id"])
+        self.assertFalse(await MediaUpload.objects.filter(id=status["upload_id"]).aexists())
+        await communicator.disconnect()
+
+    async def test_upload_store_failure_cleaned_up_failure(self):
+        await self.asyncSetUp()
+        image_data = generate_test_image()
+        communicator = await self.connect()
+        status = await send_upload_begin(communicator, len(image_data))
+        await send_upload_chunk(communicator, status["upload_id"], 0, image_data)
+        upload = await MediaUpload.objects.aget(id=status["upload_id"])
+        
+        with patch("chat.media.MediaStore.store", side_effect=OSError("disk full")), self.assertLogs("chat.consumers"):
+            await send_upload_commit(communicator, upload.id)
+            error = json.loads(await communicator.receive_from())
+        self.assertEqual(
+            error, {"type": "chat.error", "content": "Upload could not be stored.", "upload_id": upload.id}
+        )
+        self.assertFalse(await MediaUpload.objects.filter(id=upload.id).aexists())
+        self.assertFalse(os.path.exists(ChunkedUpload.get_partial_path(upload)))
+        
+        # The connection is still usable
+        status = await send_upload_begin(communicator, len(image_data))
+        self.assertEqual(status["type"], "chat.upload")
+        await communicator.disconnect()
+        
+        
+class RoomNotificationTestCase(APITransactionTestCase):
+    async def asyncSetUp(self):
+        user_instance = TestUser(email="admin@gmail.com", is_email_verified=True, is_2fa_enabled=True)
+        self.user = await user_instance.create_user()
+        self.token = await user_instance.create_token()
+        self.room = await user_instance.create_room(room_name="test")
+        await add_user_to_room(self.room, self.user)
+        self.users = await User.objects.abulk_create(
+            [User(email=f"user{index:02}@gmail.com", username=f"user{index:02}", is_test_user=True) for index in range(15)]
+        )
+        self.application = URLRouter([path("testws/room/<str:room_id>/", RoomConsumer.as_asgi())])
+        
+    async def connect(self):
+        communicator = WebsocketCommunicator(
+            self.application, f"/testws/room/{self.room.id}/", headers={"Authorization": f"Bearer {self.token}"}
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_from()
+        return communicator
+
+    async def test_bulk_add_summarised_in_one_notification_success(self):
+        await self.asyncSetUp()
+        communicator = await self.connect()
+        
+        await self.room.users.aadd(*self.users)
+        notification = json.loads(await communicator.receive_from())
+        self.assertEqual(notification["count"], 15)
+        self.assertEqual(notification["usernames"], [f"user{index:02}" for index in range(10)])
+        self.assertTrue(notification["content"].endswith("user09 and 5 others joined the chat."))
+        self.assertTrue(await communicator.receive_nothing())
+        
+        await communicator.disconnect()
+
+    async def test_notifications_coalesced_success(self):
+        await self.asyncSetUp()
+        communicator = await self.connect()
+        
+        await add_user_to_room(self.room, self.users[0])
+        await add_user_to_room(self.room, self.users[1])
+        notification = json.loads(await communicator.receive_from())
+        self.assertEqual(notification["content"], "user00 and user01 joined the chat.")
+        self.assertEqual(notification["count"], 2)
+        self.assertTrue(await communicator.receive_nothing())
+        
+        await communicator.disconnect()
+        
+
+    async def test_notification_arriving_during_send_delivered_success(self):
+        consumer = RoomConsumer()
+        frames = []
+        
+        async def send(text_data):
+            frames.append(json.loads(text_data))
+            if len(frames) == 1:
+                # Arrives while the first round is still being sent
+                await consumer.chat_notification(build_room_notification("left", ["user01"], 1))
+        
+        consumer.send = send
+        await consumer.chat_notification(build_room_notification("joined", ["user00"], 1))
+        await consumer.notification_task
+        self.assertEqual([frame["content"] for frame in frames], ["user00 joined the chat.", "user01 left the chat."])
+
+    async def test_notification_frame_encoded_once_success(self):
+        encode_room_notification.cache_clear()
+        consumers = [RoomConsumer() for index in range(3)]
+        frames = []
+        for consumer in consumers:
+            consumer.send = AsyncMock(side_effect=frames.append)
+        
+        with patch("chat.utils.encode_frame", wraps=encode_frame) as encode:
+            for consumer in consumers:
+                await consumer.chat_notification(build_room_notification("joined", ["user00"], 1))
+                await consumer.chat_notification(build_room_notification("joined", ["user01"], 1))
+            await asyncio.gather(*(consumer.notification_task for consumer in consumers))
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(json.loads(frames[0])["content"], "user00 and user01 joined the chat.")
+
+        
+class ConnectAuthorizationCacheTestCase(APITransactionTestCase):
+    def setUp(self):
+        authorized_user_cache.clear()
+        room_membership_cache.clear()
+        self.user = User.objects.create_user(email="admin@gmail.com", is_email_verified=True)
+        self.token = RefreshToken.for_user(self.user).access_token
+        self.user.access_token.access_token = self.token
+        self.user.access_token.save(update_fields=["access_token"])
+        self.room = Room.objects.create(room_name="test", creator=self.user)
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+    def test_authorization_cached_until_rotation_success(self):
+        with self.assertNumQueries(1):
+            user = async_to_sync(confirm_authorization)(self.headers)
+        self.assertEqual(user.id, self.user.id)
+        with self.assertNumQueries(0):
+            cached_user = async_to_sync(confirm_authorization)(self.headers)
+        self.assertEqual(cached_user.id, self.user.id)
+        self.assertIsNot(cached_user, user)
+        
+        # Rotating the access token drops the cached entry and the old token stops working
+        self.user.access_token.access_token = RefreshToken.for_user(self.user).access_token
+        self.user.access_token.save(update_fields=["access_token"])
+        self.assertIsNone(async_to_sync(confirm_authorization)(self.headers))
+
+    def test_rotated_token_forgotten_after_commit_success(self):
+        async_to_sync(confirm_authorization)(self.headers)
+        with transaction.atomic():
+            self.user.access_token.access_token = RefreshToken.for_user(self.user).access_token
+            self.user.access_token.save(update_fields=["access_token"])
+            self.assertIsNotNone(authorized_user_cache.get(str(self.token)))
+        self.assertIsNone(authorized_user_cache.get(str(self.token)))
+        self.assertIsNone(async_to_sync(confirm_authorization)(self.headers))
+
+    def test_room_membership_cached_until_change_success(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(async_to_sync(check_user_in_room)(self.user.id, self.room.id))
+        
+        self.room.users.add(self.user)
+        with self.assertNumQueries(1):
+            self.assertTrue(async_to_sync(check_user_in_room)(self.user.id, self.room.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(async_to_sync(check_user_in_room)(self.user.id, self.room.id))
+        
+        self.room.users.remove(self.user)
+        self.assertFalse(async_to_sync(check_user_in_room)(self.user.id, self.room.id))
+        
+        
+class PresenceTrackerTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="admin@gmail.com", is_test_user=True)
+        self.user2 = User.objects.create_user(email="admin2@gmail.com", is_test_user=True)
+        self.tracker = PresenceTracker(timeout=60, persist_delay=60, broadcast_delay=0.01)
+
+    async def test_active_count_and_status_success(self):
+        await self.tracker.connect("channel-1", "room-1", self.user.id)
+        await self.tracker.connect("channel-2", "room-1", self.user.id)
+        await self.tracker.connect("channel-3", "room-2", self.user.id)
+        await self.tracker.connect("channel-4", "room-1", self.user2.id)
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 2)
+        self.assertEqual(await self.tracker.get_active_count("room-2"), 1)
+        
+        # A user stays online while connected anywhere
+        await self.tracker.disconnect("channel-1")
+        await self.tracker.disconnect("channel-2")
+        await self.tracker.disconnect("channel-4")
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 0)
+        await self.tracker.flush()
+        self.assertTrue((await User.objects.aget(id=self.user.id)).is_online)
+        self.assertFalse((await User.objects.aget(id=self.user2.id)).is_online)
+        
+        await self.tracker.disconnect("channel-3")
+        await self.tracker.flush()
+        self.assertFalse((await User.objects.aget(id=self.user.id)).is_online)
+
+    async def test_presence_shared_between_workers_success(self):
+        other_tracker = PresenceTracker(timeout=60, persist_delay=60, broadcast_delay=0.01)
+        await self.tracker.connect("channel-1", "room-1", self.user.id)
+        await other_tracker.connect("channel-2", "room-1", self.user.id)
+        await other_tracker.connect("channel-3", "room-1", self.user2.id)
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 2)
+        self.assertEqual(await other_tracker.get_active_count("room-1"), 2)
+        
+        # Closing the last connection on one worker keeps the user online through the other
+        await self.tracker.disconnect("channel-1")
+        await self.tracker.flush()
+        self.assertTrue((await User.objects.aget(id=self.user.id)).is_online)
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 2)
+        
+        await other_tracker.disconnect("channel-2")
+        await other_tracker.disconnect("channel-3")
+        await other_tracker.flush()
+        self.assertFalse((await User.objects.aget(id=self.user.id)).is_online)
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 0)
+
+    async def test_broadcasts_coalesced_success(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("room-1", channel_name)
+        
+        with patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send:
+            for index in range(50):
+                await self.tracker.connect(f"channel-{index}", "room-1", f"user-{index}")
+            event = await channel_layer.receive(channel_name)
+        self.assertEqual(json.loads(event["frame"]), {"type": "chat.active", "content": 50})
+        self.assertEqual(group_send.call_count, 1)
+        
+        for index in range(50):
+            await self.tracker.disconnect(f"channel-{index}")
+        await self.tracker.flush()
+        await channel_layer.group_discard("room-1", channel_name)
+
+    async def test_stale_connections_expire_success(self):
+        self.tracker.timeout = 0.05
+        await self.tracker.connect("channel-1", "room-1", self.user.id)
+        await asyncio.sleep(0.1)
+        await self.tracker.expire()
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 0)
+        
+        # A later frame from the same connection brings it back
+        await self.tracker.heartbeat("channel-1", "room-1", self.user.id)
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 1)
+        await self.tracker.disconnect("channel-1")
+        await self.tracker.flush()
+
+    async def test_dead_worker_entries_lapse_success(self):
+        self.tracker.timeout = 0.05
+        await self.tracker.connect("channel-1", "room-1", self.user.id)
+        self.assertTrue(await self.tracker.is_online(self.user.id))
+        
+        # Entries a worker stops refreshing drop out of the shared sets
+        self.tracker.expiry_task.cancel()
+        await asyncio.sleep(0.1)
+        self.assertEqual(await self.tracker.get_active_count("room-1"), 0)
+        self.assertFalse(await self.tracker.is_online(self.user.id))
+
+
+class TypingTrackerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tracker = TypingTracker(interval=0.01, timeout=60, rate_limit=60)
+
+    async def test_typers_coalesced_and_rate_limited_success(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("room-1", channel_name)
+        
+        with patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send:
+            self.assertTrue(await self.tracker.update("room-1", "bob", True))
+            self.assertTrue(await self.tracker.update("room-1", "alice", True))
+            self.assertFalse(await self.tracker.update("room-1", "bob", True))
+            event = json.loads((await channel_layer.receive(channel_name))["frame"])
+            self.assertEqual(event["usernames"], ["alice", "bob"])
+            self.assertEqual(event["content"], "alice and bob are typing...")
+            self.assertEqual(group_send.call_count, 1)
+            
+            await self.tracker.update("room-1", "bob", False)
+            event = json.loads((await channel_layer.receive(channel_name))["frame"])
+            self.assertEqual(event["usernames"], ["alice"])
+            self.assertEqual(event["content"], "alice is typing...")
+        
+        await self.tracker.stop("room-1", "alice")
+        await self.tracker.broadcast_task
+        await channel_layer.group_discard("room-1", channel_name)
+
+    async def test_typers_shared_between_workers_success(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("room-1", channel_name)
+        other_tracker = TypingTracker(interval=0.01, timeout=60, rate_limit=60)
+        
+        await self.tracker.update("room-1", "bob", True)
+        await other_tracker.update("room-1", "alice", True)
+        self.assertEqual(await self.tracker.get_typers("room-1"), ["alice", "bob"])
+        # Whichever worker sends first already lists both typers
+        event = json.loads((await channel_layer.receive(channel_name))["frame"])
+        self.assertEqual(event["usernames"], ["alice", "bob"])
+        
+        await other_tracker.stop("room-1", "alice")
+        await self.tracker.stop("room-1", "bob")
+        await asyncio.gather(self.tracker.broadcast_task, other_tracker.broadcast_task)
+        # Both workers saw both changes, but each reached the room only once
+        event = json.loads((await channel_layer.receive(channel_name))["frame"])
+        self.assertEqual(event["usernames"], [])
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), 0.05)
+        await channel_layer.group_discard("room-1", channel_name)
+
+    async def test_stale_typers_expire_success(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("room-1", channel_name)
+        
+        self.tracker.timeout = 0.05
+        await self.tracker.update("room-1", "bob", True)
+        self.assertEqual(json.loads((await channel_layer.receive(channel_name))["frame"])["usernames"], ["bob"])
+        event = json.loads((await channel_layer.receive(channel_name))["frame"])
+        self.assertEqual(event, {"type": "chat.typing", "usernames": [], "content": None})
+        self.assertEqual(await self.tracker.get_typers("room-1"), [])
+        await self.tracker.broadcast_task
+        await channel_layer.group_discard("room-1", channel_name)
+
+
+class MediaValidationTestCase(SimpleTestCase):
+    def test_sniff_media_formats_success(self):
+        self.assertEqual(sniff_media_formats(generate_test_image()), {"image"})
+        self.assertEqual(sniff_media_formats(generate_test_photo()), {"image"})
+        self.assertEqual(sniff_media_formats(b"RIFF\x24\x08\x00\x00WAVEfmt "), {"audio"})
+        self.assertEqual(sniff_media_formats(b"\x00\x00\x00\x20ftypisom\x00\x00"), {"audio", "video"})
+        self.assertEqual(sniff_media_formats(b"<html><body>"), set())
+
+    @override_settings(CHAT_MEDIA_MAX_SIZES={"image": 100, "audio": 100, "video": 100})
+    def test_validate_media_success(self):
+        self.assertIsNone(validate_media("image", 100, generate_test_image()))
+        self.assertIsNotNone(validate_media("image", 101))
+        self.assertIsNotNone(validate_media("document", 10))
+        self.assertIsNotNone(validate_media("audio", 10, generate_test_image()))
+
+
+class FrameEncodingTestCase(SimpleTestCase):
+    def test_frame_event_success(self):
+        event = {"type": "chat.media", "id": "abc", "content": "x", "media_url": "/media/a.png", "media_format": "IMG"}
+        frame_event = build_frame_event(event, "id", "media_url")
+        self.assertEqual(frame_event["type"], "chat.media")
+        self.assertEqual(frame_event["id"], "abc")
+        self.assertNotIn("content", frame_event)
+        self.assertEqual(json.loads(frame_event["frame"]), event)
+
+    @override_settings(CHAT_JSON_ENCODER="orjson")
+    def test_orjson_frame_success(self):
+        try:
+            import orjson
+        except ImportError:
+            self.skipTest("orjson is not installed")
+        event = {"type": "chat.message", "content": "héllo", "created": "2024-01-01"}
+        frame = encode_frame(event)
+        self.assertIsInstance(frame, str)
+        self.assertEqual(json.loads(frame), event)
+
+    async def test_group_message_encoded_once_success(self):
+        channel_layer = get_channel_layer()
+        channel_names = [await channel_layer.new_channel() for i in range(3)]
+        for channel_name in channel_names:
+            await channel_layer.group_add("room-1", channel_name)
+        
+        with patch("chat.utils.encode_frame", wraps=encode_frame) as encode:
+            await channel_layer.group_send("room-1", build_frame_event({"type": "chat.message", "content": "hi"}))
+            frames = [(await channel_layer.receive(channel_name))["frame"] for channel_name in channel_names]
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(len(set(frames)), 1)
+        
+        for channel_name in channel_names:
+            await channel_layer.group_discard("room-1", channel_name)
+
+
+@override_settings(MEDIA_ROOT=mkdtemp())
+class MessageWriterTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="admin@gmail.com", is_email_verified=True)
+        self.room = Room.objects.create(room_name="test", creator=self.user)
+        self.consumer_message = ConsumerMessage(self.room)
+
+    def test_message_created_with_single_insert_success(self):
+        with self.assertNumQueries(1):
+            message_data = async_to_sync(self.consumer_message.create_new_message)("hello", self.user)
+        self.assertEqual(Message.objects.get(id=message_data["id"]).text_content, "hello")
+        
+        media_blob = async_to_sync(self.consumer_message.store_media_file)(
+            generate_test_image(), "test.png", "image"
+        )
+        with self.assertNumQueries(1):
+            message_id, created = async_to_sync(self.consumer_message.create_new_media_message)(
+                self.user, media_blob
+            )
+        message = Message.objects.get(id=message_id)
+        self.assertEqual(message.message_format, "IMG")
+        self.assertEqual(message.image_content.url, media_blob.file.url)
+        self.assertEqual(message.media_blob_id, media_blob.id)
+
+    def test_failed_media_message_insert_releases_media_success(self):
+        media_blob = async_to_sync(self.consumer_message.store_media_file)(generate_test_image(), "test.png", "image")
+        
+        with patch.object(Message, "asave", side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                async_to_sync(self.consumer_message.create_new_media_message)(self.user, media_blob)
+        self.assertFalse(MediaBlob.objects.filter(id=media_blob.id).exists())
+        self.assertFalse(media_blob.file.storage.exists(media_blob.file.name))
+
+    def test_messages_batched_into_one_insert_success(self):
+        message_writer = MessageWriter(batch_window=0.05, batch_size=10)
+        
+        async def create_messages():
+            return await asyncio.gather(
+                *(message_writer.create(text_content=f"message {index}", sender=self.user, room=self.room) for index in range(5))
+            )
+        
+        with CaptureQueriesContext(connection) as context:
+            messages = async_to_sync(create_messages)()
+        insert_queries = [query for query in context.captured_queries if query["sql"].startswith("INSERT")]
+        self.assertEqual(len(insert_queries), 1)
+        self.assertEqual(
+            set(Message.objects.values_list("id", flat=True)), {message.id for message in messages}
+        )
+
+    async def test_write_behind_messages_flushed_later_success(self):
+        message_writer = MessageWriter(batch_window=60, batch_size=10, write_behind=True)
+        message = await message_writer.create(text_content="hello", sender=self.user, room=self.room)
+        self.assertIsNotNone(message.created)
+        self.assertEqual(message_writer.get_pending(message.id), message)
+        self.assertFalse(await Message.objects.filter(id=message.id).aexists())
+        
+        await message_writer.flush()
+        stored_message = await Message.objects.aget(id=message.id)
+        self.assertEqual(stored_message.created, message.created)
+        self.assertIsNone(message_writer.get_pending(message.id))
+        message_writer.flush_task.cancel()
+
+    async def test_write_behind_batch_visible_until_stored_success(self):
+        message_writer = MessageWriter(batch_window=60, batch_size=10, write_behind=True)
+        message = await message_writer.create(text_content="hello", sender=self.user, room=self.room)
+        abulk_create = Message.objects.abulk_create
+        seen_during_insert = []
+        
+        async def inspecting_bulk_create(messages):
+            seen_during_insert.append(message_writer.get_pending(message.id))
+            return await abulk_create(messages)
+        
+        with patch.object(Message.objects, "abulk_create", inspecting_bulk_create):
+            await message_writer.flush()
+        self.assertEqual(seen_during_insert, [message])
+        self.assertIsNone(message_writer.get_pending(message.id))
+        message_writer.flush_task.cancel()
+
+    async def test_write_behind_flush_kept_until_done_success(self):
+        message_writer = MessageWriter(batch_window=60, batch_size=2, write_behind=True)
+        messages = [
+            await message_writer.create(text_content=f"message {index}", sender=self.user, room=self.room)
+            for index in range(2)
+        ]
+        self.assertEqual(len(message_writer.background_flushes), 1)
+        
+        # Only the writer holds the task, and it survives a garbage collection to finish the INSERT
+        gc.collect()
+        await asyncio.gather(*message_writer.background_flushes)
+        self.assertEqual(await Message.objects.filter(id__in=[message.id for message in messages]).acount(), 2)
+        self.assertFalse(message_writer.background_flushes)
+        
+    async def test_failed_batch_retried_per_row_success(self):
+        message_writer = MessageWriter(batch_window=60, batch_size=10, write_behind=True)
+        other_room = await Room.objects.acreate(room_name="other", creator=self.user)
+        stored_message = await Message.objects.acreate(text_content="stored", sender=self.user, room=self.room)
+        media_blob = await self.consumer_message.store_media_file(generate_test_image(), "test.png", "image")
+        message = await message_writer.create(text_content="hello", sender=self.user, room=self.room)
+        other_message = await message_writer.create(text_content="hello", sender=self.user, room=other_room)
+        # Reuses a stored id, so its INSERT fails and takes the bulk INSERT down with it
+        await message_writer.create(
+            id=stored_message.id,
+            message_format="IMG",
+            sender=self.user,
+            room=self.room,
+            media_blob=media_blob,
+            image_content=media_blob.file.name,
+        )
+        
+        with self.assertLogs("chat.persistence") as logs:
+            await message_writer.flush()
+        self.assertEqual(len(logs.records), 1)
+        self.assertTrue(await Message.objects.filter(id=message.id).aexists())
+        self.assertTrue(await Message.objects.filter(id=other_message.id).aexists())
+        self.assertEqual((await Message.objects.aget(id=stored_message.id)).text_content, "stored")
+        self.assertFalse(await MediaBlob.objects.filter(id=media_blob.id).aexists())
+        message_writer.flush_task.cancel()
+        
+        
+def exit_worker(*args):
+    # Stands in for a pool worker killed mid-decode (e.g. by the OOM killer)
+    os._exit(1)
+
+
+class ImageDerivativesTestCase(SimpleTestCase):
+    def test_photo_derivatives_success(self):
+        image = build_image_derivatives(generate_test_photo(), 320, 16)
+        self.assertEqual(image["extension"], ".jpg")
+        # Rotated upright by its EXIF orientation, then stored without the EXIF block
+        self.assertEqual((image["width"], image["height"]), (400, 800))
+        with Image.open(BytesIO(image["data"])) as stored_image:
+            self.assertEqual(stored_image.size, (400, 800))
+            self.assertEqual(dict(stored_image.getexif()), {})
+        with Image.open(BytesIO(image["thumbnail"])) as thumbnail:
+            self.assertEqual(thumbnail.format, "WEBP")
+            self.assertEqual(thumbnail.size, (160, 320))
+        self.assertTrue(image["placeholder"].startswith("data:image/webp;base64,"))
+        self.assertLess(len(image["placeholder"]), 500)
+
+    def test_not_an_image_failure(self):
+        self.assertIsNone(build_image_derivatives(b"not an image", 320, 16))
+
+    def test_undecodable_image_failure(self):
+        # Pillow raises SyntaxError for some malformed headers
+        with patch("chat.images.Image.open", side_effect=SyntaxError("broken PNG file")):
+            self.assertIsNone(build_image_derivatives(generate_test_image(), 320, 16))
+
+    async def test_dead_worker_replaced_success(self):
+        image_processor = ImageProcessor(processes=1)
+        with patch("chat.media.build_image_derivatives", exit_worker):
+            self.assertIsNone(await image_processor.process(generate_test_image()))
+        self.assertIsNone(image_processor.pool)
+        
+        self.assertEqual((await image_processor.process(generate_test_image(size=(20, 10))))["width"], 20)
+        image_processor.shutdown()
+
+
+@override_settings(MEDIA_ROOT=mkdtemp())
+class MediaStoreTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="admin@gmail.com", is_email_verified=True)
+        self.rooms = [Room.objects.create(room_name=f"test-{index}", creator=self.user) for index in range(3)]
+
+    def send_image(self, room, image_data):
+        consumer_message = ConsumerMessage(room)
+        media_blob = async_to_sync(consumer_message.store_media_file)(image_data, "forwarded.png", "image")
+        message_id, created = async_to_sync(consumer_message.create_new_media_message)(self.user, media_blob)
+        return Message.objects.get(id=message_id)
+
+    def test_duplicate_media_stored_once_success(self):
+        image_data = generate_test_image()
+        messages = [self.send_image(room, image_data) for room in self.rooms]
+        
+        media_blob = MediaBlob.objects.get()
+        self.assertEqual(media_blob.id, sha256(image_data).hexdigest())
+        self.assertEqual(media_blob.ref_count, 3)
+        self.assertEqual(media_blob.size, len(image_data))
+        self.assertEqual({message.image_content.name for message in messages}, {media_blob.file.name})
+        self.assertEqual(os.listdir(os.path.dirname(media_blob.file.path)), [os.path.basename(media_blob.file.path)])
+        
+        # Different bytes get their own blob
+        self.send_image(self.rooms[0], generate_test_image(color=(0, 0, 0)))
+        self.assertEqual(MediaBlob.objects.count(), 2)
+
+    def test_image_processed_in_pool_success(self):
+        photo = generate_test_photo(size=(1200, 600))
+        message = self.send_image(self.rooms[0], photo)
+        media_blob = message.media_blob
+        
+        self.assertTrue(media_blob.file.name.endswith(".jpg"))
+        self.assertEqual((media_blob.width, media_blob.height), (600, 1200))
+        self.assertEqual(media_blob.size, media_blob.file.size)
+        self.assertTrue(media_blob.thumbnail.name.startswith("thumbnails/"))
+        self.assertEqual(encode_message(message)["thumbnail_url"], media_blob.thumbnail.url)
+        self.assertEqual(encode_message(message)["placeholder"], media_blob.placeholder)
+        
+        message.delete()
+        self.assertFalse(os.path.exists(media_blob.thumbnail.path))
+
+    def test_media_released_with_last_message_success(self):
+        image_data = generate_test_image()
+        messages = [self.send_image(room, image_data) for room in self.rooms[:2]]
+        media_blob = MediaBlob.objects.get()
+        
+        messages[0].delete()
+        media_blob.refresh_from_db()
+        self.assertEqual(media_blob.ref_count, 1)
+        self.assertTrue(os.path.exists(media_blob.file.path))
+        
+        self.rooms[1].delete()
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(os.path.exists(media_blob.file.path))
+
+
 class RoomListViewTestCase(APITransactionTestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -165,8 +1016,36 @@ class RoomListViewTestCase(APITransactionTestCase):
         response = self.client.get(
             self.url, headers={"Authorization": f"Bearer {self.token}"}
         )
-        self.assertEqual(type(response.data[0]), dict)
+        self.assertEqual(type(response.data["results"][0]), dict)
+        self.assertEqual(response.status_code, 200)
+
+    def test_room_list_paginated_and_filtered_success(self):
+        other_user = User.objects.create_user(email="other@gmail.com", is_email_verified=True, is_test_user=True)
+        Room.objects.create(room_name="other", creator=other_user).users.add(other_user)
+        for index in range(25):
+            Room.objects.create(room_name=f"room-{index}", creator=other_user).users.add(self.user, other_user)
+        
+        response = self.client.get(self.url, headers={"Authorization": f"Bearer {self.token}"})
+        self.assertEqual(len(response.data["results"]), 20)
+        self.assertEqual(set(response.data["results"][0]["users"]), {self.user.id, other_user.id})
+        next_response = self.client.get(response.data["next"], headers={"Authorization": f"Bearer {self.token}"})
+        room_names = [room["room_name"] for room in response.data["results"] + next_response.data["results"]]
+        self.assertEqual(len(room_names), 26)
+        self.assertIn("test", room_names)
+        self.assertNotIn("other", room_names)
+
+    def test_room_list_not_modified_success(self):
+        self.room.users.add(self.user)
+        response = self.client.get(self.url, headers={"Authorization": f"Bearer {self.token}"})
+        etag = response["ETag"]
+        
+        response = self.client.get(self.url, headers={"Authorization": f"Bearer {self.token}", "If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        
+        Room.objects.create(room_name="test2", creator=self.user)
+        response = self.client.get(self.url, headers={"Authorization": f"Bearer {self.token}", "If-None-Match": etag})
         self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
 
     def test_create_room_success(self):
         response = self.client.post(
@@ -176,6 +1055,36 @@ class RoomListViewTestCase(APITransactionTestCase):
         )
         self.assertIsNotNone(response.data["users"])
 
+    def test_create_room_bulk_members_success(self):
+        users = User.objects.bulk_create(
+            [User(email=f"user{index}@gmail.com", username=f"user{index}", is_test_user=True) for index in range(30)]
+        )
+        self.room.users.add(users[0])
+        user_ids = [user.id for user in users] + ["missing-user-id"]
+        
+        added_user_ids = []
+        def record_added_users(sender, action, pk_set, **kwargs):
+            if action == "post_add":
+                added_user_ids.append(pk_set)
+        
+        m2m_changed.connect(record_added_users, sender=Room.users.through)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    self.url,
+                    headers={"Authorization": f"Bearer {self.token}"},
+                    data={"room_name": "test2", "user_ids": user_ids},
+                    format="json",
+                )
+        finally:
+            m2m_changed.disconnect(record_added_users, sender=Room.users.through)
+        
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(set(response.data["users"]), {user.id for user in users[1:]})
+        self.assertEqual(added_user_ids, [{user.id for user in users[1:]}])
+        through_inserts = [query for query in queries.captured_queries if "INTO \"chat_room_users\"" in query["sql"]]
+        self.assertEqual(len(through_inserts), 1)
+
     def test_create_room_failure_existing_chambername(self):
         for i in range(2):
             response = self.client.post(
@@ -186,4 +1095,264 @@ class RoomListViewTestCase(APITransactionTestCase):
         self.assertEqual("Room with this room name already exists.", response.data)
         
     def tearDown(self):
-        return super().tearDown()
\ No newline at end of file
+        return super().tearDown()
+        
+        
+@override_settings(MEDIA_ROOT=mkdtemp())
+class MediaViewTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True, is_test_user=True
+        )
+        JWTAccessToken.objects.create(user=self.user)
+        self.token = RefreshToken.for_user(self.user).access_token
+        self.user.access_token.access_token = self.token
+        self.user.access_token.save(update_fields=["access_token"])
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+        self.room = Room.objects.create(room_name="test", creator=self.user)
+        self.room.users.add(self.user)
+        consumer_message = ConsumerMessage(self.room)
+        self.media_data = generate_test_image(size=(64, 64))
+        self.media_blob = async_to_sync(consumer_message.store_media_file)(self.media_data, "test.png", "image")
+        async_to_sync(consumer_message.create_new_media_message)(self.user, self.media_blob)
+        self.url = self.media_blob.file.url
+
+    def test_retrieve_media_success(self):
+        response = self.client.get(self.url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.media_data)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response["Content-Length"], str(len(self.media_data)))
+        self.assertEqual(response["ETag"], f'"{self.media_blob.id}"')
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        
+        response = self.client.get(self.url, headers={**self.headers, "If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def test_retrieve_media_range_success(self):
+        size = len(self.media_data)
+        response = self.client.get(self.url, headers={**self.headers, "Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.media_data[10:20])
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{size}")
+        self.assertEqual(response["Content-Length"], "10")
+        
+        response = self.client.get(self.url, headers={**self.headers, "Range": "bytes=-5"})
+        self.assertEqual(b"".join(response.streaming_content), self.media_data[-5:])
+        
+        response = self.client.get(self.url, headers={**self.headers, "Range": f"bytes={size}-"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{size}")
+        
+        # A stale If-Range validator gets the whole file instead of a range of the wrong bytes
+        response = self.client.get(self.url, headers={**self.headers, "Range": "bytes=0-9", "If-Range": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_retrieve_media_streamed_under_asgi_success(self):
+        response = await self.async_client.get(self.url, headers={**self.headers, "Range": "bytes=100-"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join([chunk async for chunk in response.streaming_content]), self.media_data[100:])
+
+    def test_retrieve_media_not_member_failure(self):
+        self.room.users.remove(self.user)
+        response = self.client.get(self.url, headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT_PREFIX="/protected-media/")
+    def test_retrieve_media_accel_redirect_success(self):
+        response = self.client.get(self.url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-media/{self.media_blob.file.name}")
+        self.assertEqual(response.content, b"")
+
+    def test_retrieve_thumbnail_success(self):
+        thumbnail_url = encode_message(Message.objects.get(media_blob=self.media_blob))["thumbnail_url"]
+        response = self.client.get(thumbnail_url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.media_blob.thumbnail.read())
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertEqual(response["Content-Length"], str(self.media_blob.thumbnail.size))
+        self.assertEqual(response["ETag"], f'"{self.media_blob.id}-thumbnail"')
+        
+        response = self.client.get(thumbnail_url, headers={**self.headers, "If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        
+        self.room.users.remove(self.user)
+        self.assertEqual(self.client.get(thumbnail_url, headers=self.headers).status_code, 404)
+
+    def test_media_stored_before_blobs_backfilled_success(self):
+        media_data = generate_test_image(size=(32, 32), color=(0, 0, 0))
+        message = Message.objects.create(message_format="IMG", sender=self.user, room=self.room)
+        message.image_content.save("media_1_1.png", ContentFile(media_data))
+        legacy_path = message.image_content.path
+        
+        call_command("backfill_media_blobs", stdout=StringIO())
+        message.refresh_from_db()
+        self.assertEqual(message.media_blob_id, sha256(media_data).hexdigest())
+        self.assertEqual(message.image_content.name, message.media_blob.file.name)
+        self.assertFalse(os.path.exists(legacy_path))
+        
+        response = self.client.get(message.image_content.url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), media_data)
+        
+        # Deleting the message now releases the file like any other
+        message.delete()
+        self.assertFalse(MediaBlob.objects.filter(id=sha256(media_data).hexdigest()).exists())
+
+
+class RoomMessageListViewTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True, is_test_user=True
+        )
+        JWTAccessToken.objects.create(user=self.user)
+        self.token = RefreshToken.for_user(self.user).access_token
+        self.user.access_token.access_token = self.token
+        self.user.access_token.save(update_fields=["access_token"])
+
+        self.room = Room.objects.create(room_name="test", creator=self.user)
+        self.room.users.add(self.user)
+        other_room = Room.objects.create(room_name="other", creator=self.user)
+        # Messages sharing a timestamp are ordered (and paged) by id
+        created = timezone.now()
+        Message.objects.bulk_create(
+            [Message(text_content=f"{index}", sender=self.user, room=self.room, created=created) for index in range(15)]
+            + [Message(text_content=f"{index}", sender=self.user, room=self.room) for index in range(10)]
+            + [Message(text_content="other", sender=self.user, room=other_room) for index in range(5)]
+        )
+        self.url = reverse("chat:room-messages", kwargs={"room_id": self.room.id})
+
+    def get_messages(self, url, **params):
+        return self.client.get(url, params, headers={"Authorization": f"Bearer {self.token}"})
+
+    def test_message_history_keyset_paginated_success(self):
+        message_ids = []
+        url = self.url
+        while url:
+            response = self.get_messages(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data["results"]), 10)
+            message_ids += [message["id"] for message in response.data["results"]]
+            url = response.data["next"]
+        
+        self.assertEqual(
+            message_ids, list(Message.objects.filter(room=self.room).order_by("-created", "-id").values_list("id", flat=True))
+        )
+        
+        response = self.get_messages(self.url, page_size=1000)
+        self.assertEqual(len(response.data["results"]), 25)
+        with override_settings(CHAT_MESSAGE_MAX_PAGE_SIZE=20):
+            response = self.get_messages(self.url, page_size=1000)
+        self.assertEqual(len(response.data["results"]), 20)
+        
+        response = self.get_messages(self.url, cursor="not-a-cursor")
+        self.assertEqual(response.status_code, 404)
+
+    def test_message_history_not_member_failure(self):
+        self.room.users.remove(self.user)
+        response = self.get_messages(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_message_history_uses_index_range_scan_success(self):
+        first_page = self.get_messages(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            self.get_messages(first_page.data["next"])
+        history_query = [query["sql"] for query in queries if '"chat_message"."created" <' in query["sql"]][0]
+        
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {history_query}")
+            plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn("USING INDEX chat_message_history_idx (room_id=? AND created<?)", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class RoomHTMLViewTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True, is_test_user=True
+        )
+        JWTAccessToken.objects.create(user=self.user)
+        self.token = RefreshToken.for_user(self.user).access_token
+        self.user.access_token.access_token = self.token
+        self.user.access_token.save(update_fields=["access_token"])
+
+    def create_room_with_messages(self, room_name, count):
+        room = Room.objects.create(room_name=room_name, creator=self.user)
+        room.users.add(self.user)
+        previous_message = Message.objects.create(text_content="Hello.", sender=self.user, room=room)
+        for i in range(count - 1):
+            previous_message = Message.objects.create(
+                text_content="Hello. You.",
+                is_reply=True,
+                previous_message_content=previous_message.text_content,
+                previous_message_id=previous_message.id,
+                previous_sender=previous_message.sender_id,
+                previous_sender_username=self.user.username,
+                previous_message_format=previous_message.message_format,
+                sender=self.user,
+                room=room,
+            )
+        return room
+
+    def get_messages(self, room):
+        return self.client.get(
+            reverse("chat:room-home", kwargs={"room_id": room.id}),
+            headers={"Authorization": f"Bearer {self.token}", "Accept": "application/json"},
+        )
+
+    def test_message_list_query_count_constant_success(self):
+        small_room = self.create_room_with_messages("small", 2)
+        large_room = self.create_room_with_messages("large", 10)
+        # Warm the access token cache so both requests are measured the same way
+        self.get_messages(small_room)
+        
+        with CaptureQueriesContext(connection) as small_queries:
+            small_response = self.get_messages(small_room)
+        with CaptureQueriesContext(connection) as large_queries:
+            large_response = self.get_messages(large_room)
+        
+        self.assertEqual(len(small_response.data["results"]), 2)
+        self.assertEqual(len(large_response.data["results"]), 10)
+        self.assertEqual(len(small_queries), len(large_queries))
+        
+        reply = large_response.data["results"][0]
+        self.assertEqual(reply["previous_sender_username"], self.user.username)
+        self.assertEqual(reply["previous_message_type"], "TXT")
+        self.assertEqual(reply["sender"], self.user.id)
+        
+    def test_room_history_not_member_failure(self):
+        room = self.create_room_with_messages("test", 2)
+        room.users.remove(self.user)
+        response = self.get_messages(room)
+        self.assertEqual(response.status_code, 404)
+
+    def test_message_encoders_match_success(self):
+        room = self.create_room_with_messages("test", 2)
+        reply = Message.objects.select_related("sender").filter(room=room, is_reply=True).first()
+        
+        with self.assertNumQueries(0):
+            encoded_reply = encode_message(reply)
+        self.assertEqual(encoded_reply, MessageSerializer(reply).data)
+        self.assertEqual(encoded_reply, MessageSerializer([reply], many=True).data[0])
+        
+    def test_backfill_reply_snapshots_success(self):
+        room = Room.objects.create(room_name="test", creator=self.user)
+        message = Message.objects.create(sender=self.user, room=room, message_format="IMG")
+        reply = Message.objects.create(
+            text_content="Nice.", is_reply=True, previous_message_id=message.id, sender=self.user, room=room
+        )
+        
+        call_command("backfill_reply_snapshots", stdout=StringIO())
+        reply.refresh_from_db()
+        self.assertEqual(reply.previous_sender, self.user.id)
+        self.assertEqual(reply.previous_sender_username, self.user.username)
+        self.assertEqual(reply.previous_message_format, "IMG")
+        self.assertEqual(reply.previous_message_content, "IMAGE")
+        
+    def tearDown(self):
+        return super().tearDown()
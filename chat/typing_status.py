@@ -0,0 +1,115 @@
+from django.conf import settings
+from channels.layers import get_channel_layer
+from time import monotonic, time
+from .utils import build_frame_event, get_shared_store, get_shared_key
+import asyncio
+import json
+
+
+def build_typing_event(usernames):
+    if not usernames:
+        content = None
+    elif len(usernames) == 1:
+        content = f"{usernames[0]} is typing..."
+    else:
+        content = f"{', '.join(usernames[:-1])} and {usernames[-1]} are typing..."
+    return {"type": "chat.typing", "usernames": usernames, "content": content}
+
+
+class TypingTracker:
+    """
+    "Who is typing" state for each room, shared by all workers.
+
+    Typing frames from a user are accepted at most once per `rate_limit` seconds and keep
+    the user in the room's sorted set on the channel layer's shards, scored with an expiry
+    `timeout` seconds ahead. Each worker that saw a change in a room reads the merged set
+    every `interval` (dropping stale typers) and swaps it into the room's last-sent list
+    on the same shard; only the worker whose swap changed that list sends the
+    `chat.typing` event, so each change reaches the room once however many workers saw it.
+    """
+
+    def __init__(self, interval=1.0, timeout=5, rate_limit=0.5):
+        self.interval = interval
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        self.last_frames = {}
+        self.changed_rooms = set()
+        self.broadcast_task = None
+
+    @staticmethod
+    def get_key(room_id):
+        return get_shared_key("typing", room_id)
+
+    @staticmethod
+    def get_sent_key(room_id):
+        return get_shared_key("typing-sent", room_id)
+
+    async def get_typers(self, room_id):
+        key = self.get_key(room_id)
+        store = get_shared_store(key)
+        await store.zremrangebyscore(key, 0, time())
+        return sorted(username.decode("utf-8") for username in await store.zrange(key, 0, -1))
+
+    async def update(self, room_id, username, is_typing):
+        if not is_typing:
+            await self.stop(room_id, username)
+            return True
+
+        now = monotonic()
+        last_frame = self.last_frames.get((room_id, username))
+        if last_frame is not None and now - last_frame < self.rate_limit:
+            return False
+        self.last_frames[(room_id, username)] = now
+        
+        key = self.get_key(room_id)
+        pipeline = get_shared_store(key).pipeline(transaction=False)
+        pipeline.zadd(key, {username: time() + self.timeout})
+        pipeline.expire(key, int(self.timeout) + 1)
+        await pipeline.execute()
+        self.schedule_broadcast(room_id)
+        return True
+
+    async def stop(self, room_id, username):
+        self.last_frames.pop((room_id, username), None)
+        key = self.get_key(room_id)
+        await get_shared_store(key).zrem(key, username)
+        self.schedule_broadcast(room_id)
+
+    # Broadcasts run on the running loop; a task from a loop that has since closed (e.g.
+    # between tests) is simply replaced.
+
+    @staticmethod
+    def is_scheduled(task):
+        return task is not None and not task.done() and not task.get_loop().is_closed()
+
+    def schedule_broadcast(self, room_id):
+        self.changed_rooms.add(room_id)
+        if not self.is_scheduled(self.broadcast_task):
+            self.broadcast_task = asyncio.get_running_loop().create_task(self.broadcast_periodically())
+
+    async def broadcast_periodically(self):
+        while self.changed_rooms:
+            await asyncio.sleep(self.interval)
+            await self.broadcast()
+
+    async def broadcast(self):
+        # Rooms stay on the tick until their merged set is empty and that has been sent
+        for room_id in list(self.changed_rooms):
+            usernames = await self.get_typers(room_id)
+            sent_key = self.get_sent_key(room_id)
+            encoded_usernames = json.dumps(usernames)
+            # SET ... GET swaps atomically, so of the workers seeing the same change only one sends it
+            sent_usernames = await get_shared_store(sent_key).set(
+                sent_key, encoded_usernames, ex=int(self.timeout) + 1, get=True
+            )
+            if (sent_usernames or b"[]").decode("utf-8") != encoded_usernames:
+                await get_channel_layer().group_send(room_id, build_frame_event(build_typing_event(usernames)))
+            if not usernames:
+                self.changed_rooms.discard(room_id)
+
+
+typing_tracker = TypingTracker(
+    interval=settings.CHAT_TYPING_INTERVAL,
+    timeout=settings.CHAT_TYPING_TIMEOUT,
+    rate_limit=settings.CHAT_TYPING_RATE_LIMIT,
+)
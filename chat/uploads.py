@@ -0,0 +1,104 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from datetime import timedelta
+import os
+
+
+class PartialUploadFile(File):
+    # Exposing the path lets FileSystemStorage move the finished upload into place instead of copying it
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class ChunkedUpload:
+    """
+    Chunked uploads are assembled as local files under CHAT_UPLOAD_ROOT (not in the media
+    storage, which need not be a filesystem) and handed to the media store on commit.
+    Uploads not committed within CHAT_UPLOAD_EXPIRY are ignored and removed by
+    `expire_uploads`, and a user may only have CHAT_UPLOAD_MAX_OPEN open at a time.
+    """
+
+    def __init__(self, room, user):
+        from .models import MediaUpload
+
+        self.upload_model = MediaUpload
+        self.room = room
+        self.user = user
+
+    @staticmethod
+    def get_expiry_cutoff():
+        return timezone.now() - timedelta(seconds=settings.CHAT_UPLOAD_EXPIRY)
+
+    async def begin(self, media_format, size, filename, upload_id=None, previous_message_id=None):
+        if upload_id:
+            upload = await self.get_upload(upload_id)
+            if upload:
+                return upload, await self.get_offset(upload)
+
+        open_uploads = self.upload_model.objects.filter(user=self.user, created__gte=self.get_expiry_cutoff())
+        if await open_uploads.acount() >= settings.CHAT_UPLOAD_MAX_OPEN:
+            return None, 0
+
+        upload = await self.upload_model.objects.acreate(
+            media_format=media_format,
+            size=size,
+            filename=filename,
+            previous_message_id=previous_message_id,
+            user=self.user,
+            room=self.room,
+        )
+        return upload, 0
+
+    async def get_upload(self, upload_id):
+        return await self.upload_model.objects.filter(
+            id=upload_id, user=self.user, room=self.room, created__gte=self.get_expiry_cutoff()
+        ).afirst()
+
+    @staticmethod
+    def get_partial_path(upload):
+        return os.path.join(settings.CHAT_UPLOAD_ROOT, upload.partial_name)
+
+    @sync_to_async
+    def get_offset(self, upload):
+        partial_path = self.get_partial_path(upload)
+        return os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+
+    @sync_to_async
+    def write_chunk(self, upload, offset, chunk):
+        partial_path = self.get_partial_path(upload)
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        with open(partial_path, "ab") as file:
+            # Out-of-order chunks are not written; the caller resyncs the client to the current offset
+            if file.tell() == offset and offset + len(chunk) <= upload.size:
+                file.write(chunk)
+            return file.tell()
+
+    def open_partial_file(self, upload):
+        return PartialUploadFile(open(self.get_partial_path(upload), "rb"), name=upload.filename)
+
+    async def complete(self, upload):
+        # The partial file is gone unless the upload duplicated stored media and was not moved into place
+        await self.discard(upload)
+
+    @classmethod
+    def remove_partial_file(cls, upload):
+        partial_path = cls.get_partial_path(upload)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    async def discard(self, upload):
+        await sync_to_async(self.remove_partial_file)(upload)
+        await upload.adelete()
+
+
+def expire_uploads():
+    # Deletes the chunked uploads (and their partial files) abandoned for longer than CHAT_UPLOAD_EXPIRY
+    from .models import MediaUpload
+
+    expired_uploads = list(MediaUpload.objects.filter(created__lt=ChunkedUpload.get_expiry_cutoff()))
+    for upload in expired_uploads:
+        ChunkedUpload.remove_partial_file(upload)
+    MediaUpload.objects.filter(id__in=[upload.id for upload in expired_uploads]).delete()
+    return len(expired_uploads)
@@ -2,6 +2,7 @@ from django.urls import path
 from .views import (
     RoomListView,
     RoomHTMLView,
+    RoomMessageListView,
 )
 
 
@@ -9,4 +10,5 @@ app_name = "chat"
 urlpatterns = [
     path("room-list/", RoomListView.as_view(), name="room-list"),
     path("home/<str:room_id>/", RoomHTMLView.as_view(), name="room-home"),
+    path("rooms/<str:room_id>/messages/", RoomMessageListView.as_view(), name="room-messages"),
 ]
@@ -6,12 +6,19 @@ import jwt
 from django.conf import settings
 from rest_framework_simplejwt.tokens import RefreshToken
 import json
-from types import CoroutineType
 from time import time
 from random import randint
-from base64 import b64decode
-from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db.transaction import atomic
+from django.core.files.storage import default_storage
+from urllib.parse import unquote
+from io import BytesIO
+from PIL import Image
+from copy import copy
+from hashlib import sha256
+from functools import lru_cache
+from portal.cache import TTLCache
+from portal.layers import LocalBroker, ShardedChannelLayer
+from channels.layers import get_channel_layer
+import asyncio
 
 
 User = get_user_model()
@@ -25,8 +32,48 @@ class MessageFormat(TextChoices):
     IMAGE = "IMG", "Image"
     AUDIO = "AUD", "Audio"
     VIDEO = "VID", "Video"
+
+
+MEDIA_MESSAGE_FORMATS = {
+    "image": MessageFormat.IMAGE,
+    "audio": MessageFormat.AUDIO,
+    "video": MessageFormat.VIDEO,
+}
     
     
+def sniff_media_formats(header):
+    # The media formats a file can be sent as, judged by the magic number in its first bytes
+    header = bytes(header[:16])
+    if header.startswith((b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a")):
+        return {"image"}
+    if header[:4] == b"RIFF":
+        return {b"WEBP": {"image"}, b"WAVE": {"audio"}, b"AVI ": {"video"}}.get(header[8:12], set())
+    if header[4:8] == b"ftyp":
+        brand = header[8:12]
+        if brand in [b"heic", b"heix", b"mif1", b"avif"]:
+            return {"image"}
+        if brand in [b"M4A ", b"M4B "]:
+            return {"audio"}
+        return {"audio", "video"}
+    if header.startswith((b"OggS", b"\x1a\x45\xdf\xa3")):
+        return {"audio", "video"}
+    if header.startswith((b"ID3", b"fLaC")) or (header[:1] == b"\xff" and header[1:2] >= b"\xe0"):
+        return {"audio"}
+    return set()
+
+
+def validate_media(media_format, size, header=None):
+    # Returns why the media must be rejected, or None; `header` (the first bytes) is sniffed when given
+    if media_format not in MEDIA_MESSAGE_FORMATS:
+        return "Invalid media format."
+    max_size = settings.CHAT_MEDIA_MAX_SIZES[media_format]
+    if size > max_size:
+        return f"{media_format.capitalize()} files are limited to {max_size // (1024 * 1024)} MB."
+    if header is not None and media_format not in sniff_media_formats(header):
+        return f"File content is not a supported {media_format} format."
+    return None
+
+
 class RoomDetail:
     def __init__(self, room_id):
         from .models import Room
@@ -39,122 +86,210 @@ class RoomDetail:
 
     async def retrieve_room_name(self):
         return await self.room_model.objects.filter(id=self.room_id).afirst().room_name
-    
-    async def get_active_users_count(self):
-        room = await self.room_model.objects.prefetch_related("users").filter(id=self.room_id).afirst()
-        return await room.users.filter(is_online=True).acount()
 
 
-@sync_to_async
-def confirm_authorization(headers):
+# Per process: signals evict entries only in the worker that made the change, so the short
+# CHAT_AUTH_CACHE_TTL is what bounds how long other workers trust a revoked token or membership
+authorized_user_cache = TTLCache(maxsize=settings.CHAT_AUTH_CACHE_SIZE, ttl=settings.CHAT_AUTH_CACHE_TTL)
+room_membership_cache = TTLCache(maxsize=settings.CHAT_AUTH_CACHE_SIZE, ttl=settings.CHAT_AUTH_CACHE_TTL)
+
+
+async def confirm_authorization(headers):
     jwt_token = None
     if headers.get("Authorization"):
         jwt_token = headers["Authorization"].split(" ")[1]
     elif headers.get(b"authorization"):
         jwt_token = headers[b"authorization"].decode("utf-8").split(" ")[1]
     if jwt_token:
-        payload = jwt.decode(jwt_token, settings.SECRET_KEY, algorithms=["HS256"])
-        user_id = payload.get("user_id")
-        return User.objects.filter(id=user_id).first()
+        user = authorized_user_cache.get(jwt_token)
+        if user is None:
+            payload = jwt.decode(jwt_token, settings.SECRET_KEY, algorithms=["HS256"])
+            user = await User.objects.filter(
+                id=payload.get("user_id"), access_token__access_token=jwt_token
+            ).afirst()
+            if not user:
+                return None
+            authorized_user_cache.set(jwt_token, user, ttl=payload["exp"] - time())
+        # Each connection gets its own copy of the cached snapshot
+        return copy(user)
     
 
+def forget_authorized_user(user_id):
+    authorized_user_cache.delete_where(lambda jwt_token, user: user.id == user_id)
+
+
 async def check_user_in_room(user_id, room_id):
     from .models import Room
     
-    room = await Room.objects.prefetch_related("users").filter(id=room_id).afirst()
-    return await room.users.filter(id=user_id).aexists()
+    user_in_room = room_membership_cache.get((user_id, room_id))
+    if user_in_room is None:
+        user_in_room = await Room.users.through.objects.filter(room_id=room_id, user_id=user_id).aexists()
+        room_membership_cache.set((user_id, room_id), user_in_room)
+    return user_in_room
+
+
+def forget_room_membership(user_id=None, room_id=None):
+    room_membership_cache.delete_where(
+        lambda key, user_in_room: user_id in [None, key[0]] and room_id in [None, key[1]]
+    )
+
+
+def encode_frame(data):
+    if settings.CHAT_JSON_ENCODER == "orjson":
+        import orjson
+
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data)
+
+
+def build_frame_event(event, *fields):
+    # The websocket frame is encoded once by the sender and forwarded verbatim by every receiving
+    # consumer; `fields` are kept alongside it for handlers that need them (e.g. inline media)
+    frame_event = {"type": event["type"], "frame": encode_frame(event)}
+    for field in fields:
+        frame_event[field] = event[field]
+    return frame_event
+
+
+def get_shared_store(key):
+    # State every worker must see lives on the channel layer's shards; the in-memory layer
+    # only spans one process, so a process-local broker stands in for them
+    channel_layer = get_channel_layer()
+    if isinstance(channel_layer, ShardedChannelLayer):
+        return channel_layer.get_shard(key)
+    return LocalBroker.from_url("local://shared-state")
+
+
+def get_shared_key(*parts):
+    return ":".join([getattr(get_channel_layer(), "prefix", "whisper"), *map(str, parts)])
+
+
+def get_response_etag(data):
+    return sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def parse_range_header(range_header, size):
+    # Returns the (start, end) byte offsets of a single "bytes=" range, or None when the header
+    # should be ignored (multiple ranges, other units, malformed); a start past the end is
+    # returned as-is for the caller to answer with 416
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in byte_range:
+        return None
+    start, _, end = byte_range.strip().partition("-")
+    try:
+        if not start:
+            suffix_length = int(end)
+            return (max(size - suffix_length, 0), size - 1) if suffix_length > 0 else (size, size)
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if end < start < size:
+        return None
+    return start, end
+
+
+def build_room_notification(action, usernames, count):
+    # Up to CHAT_NOTIFICATION_USERNAMES_LIMIT names are listed; larger sets are summarised with a count
+    if count > len(usernames):
+        names = f"{', '.join(usernames)} and {count - len(usernames)} others"
+    elif count > 1:
+        names = f"{', '.join(usernames[:-1])} and {usernames[-1]}"
+    else:
+        names = usernames[0]
+    return {
+        "type": "chat.notification",
+        "action": action,
+        "usernames": usernames,
+        "count": count,
+        "content": f"{names} {action} the chat.",
+    }
+
+
+@lru_cache(maxsize=256)
+def encode_room_notification(action, usernames, count):
+    # Connections in a room merge the same events into the same notification, so each distinct
+    # one is built and encoded once per process rather than once per recipient
+    return encode_frame(build_room_notification(action, list(usernames), count))
+
+
+def get_message_preview(message_format, text_content):
+    if message_format == MessageFormat.IMAGE:
+        return "IMAGE"
+    elif message_format == MessageFormat.AUDIO:
+        return "AUDIO"
+    elif message_format == MessageFormat.VIDEO:
+        return "VIDEO"
+    return text_content
 
 
-async def set_user_status(user, status="online"):
-    if status == "online":
-        user.is_online = True
-    elif status == "offline":
-        user.is_online = False
-    await user.asave()
-    
 class ConsumerMessage:
     def __init__(self, room):
         from .models import Message
-        from .serializers import AsyncMessageSerializer
+        from .serializers import encode_message
+        from .persistence import message_writer
+        from .media import media_store
         
         self.message_model =  Message
-        self.message_serializer = AsyncMessageSerializer
+        self.encode_message = encode_message
+        self.message_writer = message_writer
+        self.media_store = media_store
         self.room = room
         
     async def create_new_message(self, content, user):
-        new_message = await self.message_model.objects.acreate(text_content=content, sender=user, room=self.room)
-        new_message_data = self.message_serializer(new_message).data
-        for key, value in new_message_data.items():
-            if type(value) == CoroutineType:
-                new_message_data[key] = await value
-        return new_message_data
-
-    async def get_replied_message(self, message_id):
-        message = await self.message_model.objects.filter(id=message_id, room=self.room).afirst()
-        message_data = self.message_serializer(message).data
-        for key, value in message_data.items():
-            if type(value) == CoroutineType:
-                message_data[key] = await value
-        return message_data
-
-    async def create_new_reply(self, user, previous_sender, previous_content, previous_message_id, content=None, message_format="text"):
-        new_reply = await self.message_model.objects.acreate(
+        new_message = await self.message_writer.create(text_content=content, sender=user, room=self.room)
+        return self.encode_message(new_message)
+
+    async def get_reply_snapshot(self, message_id):
+        replied_message = await self.message_model.objects.filter(id=message_id, room=self.room).values(
+            "sender_id", "sender__username", "message_format", "text_content"
+        ).afirst()
+        if not replied_message:
+            pending_message = self.message_writer.get_pending(message_id)
+            if not pending_message or pending_message.room_id != self.room.id:
+                return None
+            replied_message = {
+                "sender_id": pending_message.sender_id,
+                "sender__username": pending_message.sender.username,
+                "message_format": pending_message.message_format,
+                "text_content": pending_message.text_content,
+            }
+        return {
+            "previous_sender": replied_message["sender_id"],
+            "previous_sender_username": replied_message["sender__username"],
+            "previous_message_format": replied_message["message_format"],
+            "previous_message_content": get_message_preview(
+                replied_message["message_format"], replied_message["text_content"]
+            ),
+            "previous_message_id": message_id,
+        }
+
+    async def create_new_reply(self, user, reply_snapshot, content=None, media_blob=None):
+        media_format = media_blob.media_format if media_blob else None
+        media_fields = {f"{media_format}_content": media_blob.file.name, "media_blob": media_blob} if media_blob else {}
+        new_reply = await self.message_writer.create(
+            message_format=MEDIA_MESSAGE_FORMATS.get(media_format, MessageFormat.TEXT),
+            text_content=content or "",
             sender=user,
-            previous_sender=previous_sender,
-            previous_message_content=previous_content,
-            previous_message_id=previous_message_id,
             room=self.room,
             is_reply=True,
+            **reply_snapshot,
+            **media_fields,
         )
-        if message_format == "text":
-            new_reply.message_format = MessageFormat.TEXT
-            new_reply.text_content = content
-        elif message_format == "image":
-            new_reply.message_format = MessageFormat.IMAGE
-        elif message_format == "audio":
-            new_reply.message_format = MessageFormat.AUDIO
-        elif message_format == "video":
-            new_reply.message_format = MessageFormat.VIDEO
-
-        await new_reply.asave()
         return new_reply.id, new_reply.created
     
-    async def create_new_media_message(self, media_format, user):
-        new_message = await self.message_model.objects.acreate(sender=user, room=self.room)
-        if media_format == "image":
-            new_message.message_format = MessageFormat.IMAGE
-        elif media_format == "audio":
-            new_message.message_format = MessageFormat.AUDIO
-        elif media_format == "video":
-            new_message.message_format = MessageFormat.VIDEO
-
-        await new_message.asave(update_fields=["message_format"])
+    async def create_new_media_message(self, user, media_blob):
+        new_message = await self.message_writer.create(
+            message_format=MEDIA_MESSAGE_FORMATS[media_blob.media_format],
+            sender=user,
+            room=self.room,
+            media_blob=media_blob,
+            **{f"{media_blob.media_format}_content": media_blob.file.name},
+        )
         return new_message.id, new_message.created
     
-    @sync_to_async
-    def update_media_message(self, media_id, content, filename, media_format):
-        media_data = b64decode(content)
-        file_data = SimpleUploadedFile(
-            name=filename,
-            content=media_data,
-        )
-        media_message = self.message_model.objects.filter(id=media_id).first()
-         
-        with atomic():
-            if media_format == "image":
-                file_data.content_type = "image/png"
-                media_message.message_type = MessageFormat.IMAGE
-                media_message.image_content = file_data
-            elif media_format == "audio":
-                file_data.content_type = "audio/wav"
-                media_message.message_type = MessageFormat.AUDIO
-                media_message.audio_content = file_data
-            elif media_format == "video":
-                file_data.content_type = "video/mp4"
-                media_message.message_type = MessageFormat.VIDEO
-                media_message.video_content = file_data
-                
-            media_message.save()
+    async def store_media_file(self, media_data, filename, media_format):
+        # Stored (or deduplicated) on its own so the message row can be inserted once, already pointing at it
+        return await self.media_store.store(media_data, filename, media_format)
 
 
 async def generate_random_filename(media_format):
@@ -169,6 +304,38 @@ async def generate_random_filename(media_format):
     return f"media_{timestamp}_{random_num}.{extension}"
 
 
+def media_name_from_url(media_url):
+    return unquote(media_url.removeprefix(settings.MEDIA_URL))
+
+
+@sync_to_async
+def read_media_file(media_url):
+    with default_storage.open(media_name_from_url(media_url), "rb") as file:
+        return file.read()
+
+
+inline_media_cache = TTLCache(maxsize=settings.CHAT_INLINE_MEDIA_CACHE_SIZE, ttl=settings.CHAT_INLINE_MEDIA_CACHE_TTL)
+
+
+async def get_inline_media(media_url):
+    # Every media=inline recipient in the process handles the same event at once, so the first
+    # starts the read and the rest await it (shielded, so a disconnecting recipient can't cancel it)
+    loop = asyncio.get_running_loop()
+    read_task = inline_media_cache.get(media_url)
+    if read_task is None or read_task.get_loop() is not loop:
+        read_task = loop.create_task(read_media_file(media_url))
+        inline_media_cache.set(media_url, read_task)
+    try:
+        return await asyncio.shield(read_task)
+    except Exception:
+        inline_media_cache.delete(media_url)
+        raise
+
+
+def encode_media_frame(metadata, media_data):
+    return json.dumps(metadata).encode("utf-8") + b"<delimiter>" + media_data
+
+
 
 class TestUser:
     def __init__(self, email, username=None, is_email_verified=False, is_2fa_enabled=False):
@@ -238,14 +405,27 @@ async def send_reply_text_message(communicator, previous_message_id):
     await communicator.send_to(json.dumps(message_data))
 
 
+def generate_test_image(size=(32, 32), color=(169, 56, 56)):
+    image_buffer = BytesIO()
+    Image.new("RGB", size, color).save(image_buffer, format="PNG")
+    return image_buffer.getvalue()
+
+
+def generate_test_photo(size=(800, 400), orientation=6):
+    # A JPEG as a phone camera would send it: sideways pixels plus an EXIF orientation tag
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x010F] = "Camera Maker"
+    image_buffer = BytesIO()
+    Image.new("RGB", size, (20, 120, 200)).save(image_buffer, format="JPEG", exif=exif)
+    return image_buffer.getvalue()
+
+
 async def send_image_message(communicator):
     message_data = {"message_format": "image", "media_format": "image", "message_type": "media"}
     message_json = json.dumps(message_data).encode()
     delimiter = "<delimiter>".encode()
-
-    image_file = settings.BASE_DIR/"test-image/test.png"
-    with open(image_file, "rb") as file:
-        image_data = file.read()
+    image_data = generate_test_image()
 
     combined_data = message_json + delimiter + image_data
     await communicator.send_to(bytes_data=combined_data)
@@ -272,10 +452,26 @@ async def send_reply_image_message(communicator, previous_message_id):
     }
     message_json = json.dumps(message_data).encode()
     delimiter = "<delimiter>".encode()
-
-    image_file = settings.BASE_DIR / "test-image/test.png"
-    with open(image_file, "rb") as file:
-        image_data = file.read()
+    image_data = generate_test_image()
 
     combined_data = message_json + delimiter + image_data
-    await communicator.send_to(bytes_data=combined_data)
\ No newline at end of file
+    await communicator.send_to(bytes_data=combined_data)
+
+
+async def send_upload_begin(communicator, size, upload_id=None, media_format="image"):
+    message_data = {"message_type": "upload.begin", "media_format": media_format, "size": size}
+    if upload_id:
+        message_data["upload_id"] = upload_id
+    await communicator.send_to(json.dumps(message_data))
+    return json.loads(await communicator.receive_from())
+
+
+async def send_upload_chunk(communicator, upload_id, offset, chunk):
+    message_data = {"message_type": "upload.chunk", "upload_id": upload_id, "offset": offset}
+    await communicator.send_to(bytes_data=encode_media_frame(message_data, chunk))
+    return json.loads(await communicator.receive_from())
+
+
+async def send_upload_commit(communicator, upload_id):
+    message_data = {"message_type": "upload.commit", "upload_id": upload_id}
+    await communicator.send_to(json.dumps(message_data))
@@ -1,16 +1,91 @@
 from django.shortcuts import render
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.conf import settings
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.exceptions import NotFound
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework.pagination import CursorPagination
+from rest_framework.pagination import CursorPagination, BasePagination
+from rest_framework.utils.urls import replace_query_param
+from django.contrib.auth import get_user_model
+from django.db.models import Q, Prefetch
+from django.utils.http import parse_etags, quote_etag
+from urllib.parse import quote
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+import json
+import mimetypes
 from .serializers import RoomSerializer, Room, MessageSerializer
+from .models import MediaBlob, Message
+from .media import MediaRange, stream_media_file
+from .utils import get_response_etag, parse_range_header
 
 
-class RoomMessagePagination(CursorPagination):
-    page_size = 10
+User = get_user_model()
+
+
+class MessageHistoryPagination(BasePagination):
+    """
+    Keyset pagination over a room's messages, newest first. The cursor holds the
+    (created, id) of the last message on the page, so every page is a single range
+    scan of the (room, -created, -id) index however far back it is.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.CHAT_MESSAGE_PAGE_SIZE
+        return min(max(page_size, 1), settings.CHAT_MESSAGE_MAX_PAGE_SIZE)
+
+    @staticmethod
+    def encode_cursor(message):
+        position = json.dumps([message.created.isoformat(), message.id])
+        return urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            created, message_id = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+            return datetime.fromisoformat(created), str(message_id)
+        except (TypeError, ValueError):
+            raise NotFound("Invalid cursor")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        if cursor:
+            created, message_id = cursor
+            # created__lte bounds the index range; the OR then breaks ties on id
+            queryset = queryset.filter(
+                Q(created__lt=created) | Q(created=created, id__lt=message_id), created__lte=created
+            )
+        page = list(queryset.order_by("-created", "-id")[:page_size + 1])
+        self.next_message = page[page_size - 1] if len(page) > page_size else None
+        return page[:page_size]
+
+    def get_next_link(self):
+        if not self.next_message:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(self.next_message)
+        )
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+
+class RoomListPagination(CursorPagination):
+    page_size = 20
     ordering = "-created"
 
 
@@ -18,11 +93,24 @@ class RoomListView(APIView):
     permission_classes = [IsAuthenticated]
     authentication_classes = [JWTAuthentication]
     serializer_class = RoomSerializer
+    pagination_class = RoomListPagination
 
     def get(self, request):
-        rooms = Room.objects.all().order_by("-created")
-        rooms_data = self.serializer_class(rooms, many=True).data
-        return Response(rooms_data, status=status.HTTP_200_OK)
+        rooms = (
+            Room.objects.filter(Q(users=request.user) | Q(creator=request.user))
+            .distinct()
+            .prefetch_related(Prefetch("users", queryset=User.objects.only("id")))
+        )
+        paginator = self.pagination_class()
+        paginated_rooms = paginator.paginate_queryset(rooms, request, view=self)
+        response = paginator.get_paginated_response(self.serializer_class(paginated_rooms, many=True).data)
+        
+        # Polling clients send the last ETag back and get a 304 while their page is unchanged
+        etag = quote_etag(get_response_etag(response.data))
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        response["ETag"] = etag
+        return response
 
     def post(self, request):
         serializer = self.serializer_class(
@@ -38,14 +126,12 @@ class RoomHTMLView(APIView):
     permission_classes = [IsAuthenticated]
     authentication_classes = [JWTAuthentication]
     serializer_class = MessageSerializer
-    pagination_class = RoomMessagePagination
+    pagination_class = MessageHistoryPagination
 
     def get(self, request, room_id):
-        room = (
-            Room.objects.prefetch_related("messages").filter(id=room_id).first()
-        )
+        room = Room.objects.filter(id=room_id, users=request.user).first()
         if room:
-            messages = room.messages.order_by("-created")
+            messages = room.messages.select_related("sender", "media_blob")
 
             paginator = self.pagination_class()
             paginated_messages = paginator.paginate_queryset(
@@ -72,3 +158,83 @@ class RoomHTMLView(APIView):
             return render(request, "room.html", context)
         else:
             raise NotFound("Room with this id does not exist.")
+
+
+class RoomMessageListView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+    serializer_class = MessageSerializer
+    pagination_class = MessageHistoryPagination
+
+    def get(self, request, room_id):
+        if not Room.objects.filter(id=room_id, users=request.user).exists():
+            raise NotFound("Room with this id does not exist.")
+
+        messages = Message.objects.filter(room_id=room_id).select_related("sender", "media_blob")
+        paginator = self.pagination_class()
+        paginated_messages = paginator.paginate_queryset(messages, request, view=self)
+        return paginator.get_paginated_response(self.serializer_class(paginated_messages, many=True).data)
+
+
+class MediaView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+
+    def get(self, request, media_name):
+        # Only members of a room the media (or its thumbnail) was sent to can fetch it
+        media_blob = (
+            MediaBlob.objects.filter(Q(file=media_name) | Q(thumbnail=media_name), messages__room__users=request.user)
+            .only("id", "file", "size", "thumbnail")
+            .first()
+        )
+        if not media_blob:
+            raise NotFound("Media with this name does not exist.")
+
+        # Blobs are content-addressed, so the digest is a strong validator that never goes stale;
+        # a thumbnail is derived from the same bytes and gets its own tag
+        if media_blob.file.name == media_name:
+            media_file, size, etag = media_blob.file, media_blob.size, quote_etag(media_blob.id)
+        else:
+            media_file, size, etag = media_blob.thumbnail, None, quote_etag(f"{media_blob.id}-thumbnail")
+        content_type = mimetypes.guess_type(media_name)[0] or "application/octet-stream"
+        headers = {
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "private, max-age=31536000, immutable",
+        }
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        if settings.MEDIA_ACCEL_REDIRECT_PREFIX:
+            # nginx serves the file itself (sendfile, ranges) from its internal location
+            headers["X-Accel-Redirect"] = f"{settings.MEDIA_ACCEL_REDIRECT_PREFIX}{quote(media_name)}"
+            return HttpResponse(content_type=content_type, headers=headers)
+
+        if size is None:
+            size = media_file.size
+        byte_range = None
+        if_range = request.headers.get("If-Range")
+        if request.headers.get("Range") and (not if_range or if_range == etag):
+            byte_range = parse_range_header(request.headers["Range"], size)
+        if byte_range and byte_range[0] >= size:
+            headers["Content-Range"] = f"bytes */{size}"
+            return HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+
+        file = media_file.storage.open(media_file.name, "rb")
+        start, end = byte_range or (0, size - 1)
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            file = MediaRange(file, start, end)
+
+        block_size = settings.MEDIA_STREAM_BLOCK_SIZE
+        if isinstance(request._request, ASGIRequest):
+            response = StreamingHttpResponse(stream_media_file(file, block_size), content_type=content_type)
+        else:
+            # WSGI servers hand whole files to wsgi.file_wrapper, which uses sendfile where available
+            response = FileResponse(file, content_type=content_type)
+            response.block_size = block_size
+        response.status_code = status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK
+        for header, value in headers.items():
+            response[header] = value
+        response["Content-Length"] = end - start + 1
+        return response
@@ -25,19 +25,27 @@ elif [ "$DEBUG_VALUE" = "true" ]; then
     python3 generate_certs.py
 fi
 
-# Start appropriate server
+if [ "$SERVER_COMMAND" != "test" ]; then
+    echo "starting email worker..."
+    python3 manage.py send_queued_emails &
+    echo "starting upload sweeper..."
+    python3 manage.py expire_media_uploads &
+fi
+
+# Start appropriate server; each caps websocket messages at CHAT_MEDIA_FRAME_MAX_SIZE
 case $SERVER_COMMAND in
     "daphne")
         echo "starting daphne server..."
-        daphne -b 0.0.0.0 -p 8000 portal.asgi:application
+        python3 -m portal.daphne_server -b 0.0.0.0 -p 8000 portal.asgi:application
         ;;
     "gunicorn")
         echo "starting gunicorn server..."
-        gunicorn portal.asgi:application -k uvicorn.workers.UvicornWorker -b 0.0.0.0:8000
+        gunicorn portal.asgi:application -k portal.workers.ChatUvicornWorker -w ${SERVER_WORKERS:-1} -b 0.0.0.0:8000
         ;;
     "uvicorn")
         echo "starting uvicorn server..."
-        uvicorn portal.asgi:application --host 0.0.0.0 --port 8000 --reload
+        WS_MAX_SIZE=$(python3 manage.py shell -c "from django.conf import settings; print(settings.CHAT_MEDIA_FRAME_MAX_SIZE)")
+        uvicorn portal.asgi:application --host 0.0.0.0 --port 8000 --reload --ws-max-size "$WS_MAX_SIZE"
         ;;
     "test")
         echo "starting tests..."
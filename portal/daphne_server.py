@@ -0,0 +1,33 @@
+"""
+Runs Daphne with the same command line as `daphne`, but with websocket messages
+capped at CHAT_MEDIA_FRAME_MAX_SIZE. Daphne has no option for it and autobahn
+accepts messages of any size, buffering each one whole before the consumer can
+reject it.
+
+    python3 -m portal.daphne_server -b 0.0.0.0 -p 8000 portal.asgi:application
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+
+from django.conf import settings
+from daphne import server
+from daphne.cli import CommandLineInterface
+from daphne.ws_protocol import WebSocketFactory
+
+
+class ChatWebSocketFactory(WebSocketFactory):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        max_size = settings.CHAT_MEDIA_FRAME_MAX_SIZE
+        self.setProtocolOptions(maxFramePayloadSize=max_size, maxMessagePayloadSize=max_size)
+
+
+def main():
+    server.WebSocketFactory = ChatWebSocketFactory
+    CommandLineInterface.entrypoint()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+from channels.layers import BaseChannelLayer
+from channels.exceptions import ChannelFull
+from binascii import crc32
+from collections import defaultdict, deque
+from fnmatch import fnmatch
+from weakref import WeakKeyDictionary
+from uuid import uuid4
+from time import time
+import asyncio
+import json
+
+
+class LocalBroker:
+    """
+    In-process stand-in for the subset of redis commands used by ShardedChannelLayer.
+    Brokers are shared per "local://<name>" host, so several layer instances in one
+    process (e.g. simulated workers in tests) see the same groups and inboxes.
+    """
+
+    brokers = {}
+
+    @classmethod
+    def from_url(cls, url):
+        return cls.brokers.setdefault(url, cls())
+
+    def __init__(self):
+        self.sorted_sets = defaultdict(dict)
+        self.lists = defaultdict(deque)
+        self.values = {}
+        self.waiters = defaultdict(deque)
+
+    def pipeline(self, transaction=False):
+        return LocalPipeline(self)
+
+    async def set(self, key, value, ex=None, get=False):
+        previous_value = self.values.get(key)
+        self.values[key] = value.encode() if isinstance(value, str) else str(value).encode()
+        return previous_value if get else True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def zadd(self, key, mapping):
+        self.sorted_sets[key].update(mapping)
+
+    async def zrem(self, key, *members):
+        for member in members:
+            self.sorted_sets[key].pop(member, None)
+
+    async def zremrangebyscore(self, key, minimum, maximum):
+        sorted_set = self.sorted_sets[key]
+        for member, score in list(sorted_set.items()):
+            if minimum <= score <= maximum:
+                del sorted_set[member]
+
+    async def zrange(self, key, start, end):
+        members = sorted(self.sorted_sets[key], key=self.sorted_sets[key].get)
+        return [member.encode() for member in members[start:None if end == -1 else end + 1]]
+
+    async def zcard(self, key):
+        return len(self.sorted_sets[key])
+
+    async def rpush(self, key, *values):
+        self.lists[key].extend(values)
+        while self.waiters[key] and self.lists[key]:
+            waiter = self.waiters[key].popleft()
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(self.wake, waiter)
+        return len(self.lists[key])
+
+    @staticmethod
+    def wake(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def llen(self, key):
+        return len(self.lists[key])
+
+    async def expire(self, key, seconds):
+        return True
+
+    async def blpop(self, keys, timeout=0):
+        deadline = time() + timeout if timeout else None
+        while True:
+            for key in keys:
+                if self.lists[key]:
+                    return key.encode(), self.lists[key].popleft()
+
+            waiter = asyncio.get_running_loop().create_future()
+            for key in keys:
+                self.waiters[key].append(waiter)
+            try:
+                await asyncio.wait_for(waiter, None if deadline is None else max(deadline - time(), 0))
+            except asyncio.TimeoutError:
+                return None
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.sorted_sets.pop(key, None)
+            self.lists.pop(key, None)
+            self.values.pop(key, None)
+
+    async def scan_iter(self, match):
+        for key in list(self.sorted_sets) + list(self.lists) + list(self.values):
+            if fnmatch(key, match):
+                yield key.encode()
+
+
+class LocalPipeline:
+    def __init__(self, broker):
+        self.broker = broker
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue_command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue_command
+
+    async def execute(self):
+        return [await getattr(self.broker, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """
+    Channel layer that spreads groups and inboxes over several redis hosts.
+
+    Each group (room id) lives on the shard picked by a stable hash of its name, and
+    process-specific channels share one inbox list per layer instance, so a worker
+    only ever blocks on one BLPOP. Capacity is per channel: each worker publishes how
+    many channels share its inbox, senders scale the inbox limit by that count, and each
+    channel buffers at most `capacity` messages locally. group_send encodes the message
+    once and pipelines the pushes per shard (pre-encoded websocket frames are carried as
+    raw bytes).
+    Hosts with the "local://" scheme use the in-process LocalBroker instead of redis.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        hosts=None,
+        prefix="whisper",
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        blocking_timeout=5,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.hosts = hosts or ["redis://localhost:6379"]
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.blocking_timeout = blocking_timeout
+        self.client_prefix = uuid4().hex
+        self.shard_connections = WeakKeyDictionary()
+        # Buffers exist only for channels created here and still being received on
+        self.receive_buffers = {}
+        self.receive_tasks = WeakKeyDictionary()
+        self.publish_tasks = set()
+
+    # Shards
+
+    def connect(self, host):
+        if host.startswith("local://"):
+            return LocalBroker.from_url(host)
+
+        from redis.asyncio import Redis
+
+        return Redis.from_url(host)
+
+    def get_shards(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.shard_connections:
+            self.shard_connections[loop] = [self.connect(host) for host in self.hosts]
+        return self.shard_connections[loop]
+
+    def get_shard_index(self, key):
+        return crc32(key.encode()) % len(self.hosts)
+
+    def get_shard(self, key):
+        return self.get_shards()[self.get_shard_index(key)]
+
+    # Keys and payloads
+
+    def get_group_key(self, group):
+        return f"{self.prefix}:group:{group}"
+
+    def get_inbox_key(self, channel):
+        return f"{self.prefix}:inbox:{self.non_local_name(channel)}"
+
+    @staticmethod
+    def get_channel_count_key(inbox_key):
+        return f"{inbox_key}:channels"
+
+    def get_inbox_capacity(self, channel, channel_count):
+        # The count is missing until the receiving worker has published it
+        return self.get_capacity(channel) * max(int(channel_count or 1), 1)
+
+    @staticmethod
+    def encode_message(message):
+        # A pre-encoded "frame" travels as raw bytes after the JSON header (which never contains
+        # a newline) instead of being escaped into it and parsed again by every receiver
+        if isinstance(message.get("frame"), str):
+            header = {key: value for key, value in message.items() if key != "frame"}
+            return json.dumps(header).encode("utf-8") + b"\n" + message["frame"].encode("utf-8")
+        return json.dumps(message).encode("utf-8")
+
+    @staticmethod
+    def decode_message(body):
+        header, separator, frame = body.partition(b"\n")
+        message = json.loads(header)
+        if separator:
+            message["frame"] = frame.decode("utf-8")
+        return message
+
+    @staticmethod
+    def build_payload(channel, body):
+        return channel.encode("utf-8") + b"\n" + body
+
+    def parse_payload(self, payload):
+        channel, body = payload.split(b"\n", 1)
+        return channel.decode("utf-8"), self.decode_message(body)
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific"):
+        channel = f"{prefix}.{self.client_prefix}!{uuid4().hex}"
+        self.receive_buffers[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        await self.publish_channel_count(self.get_inbox_key(channel))
+        return channel
+
+    async def publish_channel_count(self, inbox_key):
+        channel_count = sum(1 for channel in self.receive_buffers if self.get_inbox_key(channel) == inbox_key)
+        await self.get_shard(inbox_key).set(self.get_channel_count_key(inbox_key), channel_count, ex=self.group_expiry)
+
+    def discard_channel(self, channel):
+        if self.receive_buffers.pop(channel, None) is not None:
+            # Called from a cancelled receive(), so the new count is published in the background
+            inbox_key = self.get_inbox_key(channel)
+            publish_task = asyncio.get_running_loop().create_task(self.publish_channel_count(inbox_key))
+            self.publish_tasks.add(publish_task)
+            publish_task.add_done_callback(self.publish_tasks.discard)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+
+        inbox_key = self.get_inbox_key(channel)
+        shard = self.get_shard(inbox_key)
+        pipeline = shard.pipeline(transaction=False)
+        pipeline.llen(inbox_key)
+        pipeline.get(self.get_channel_count_key(inbox_key))
+        inbox_length, channel_count = await pipeline.execute()
+        if inbox_length >= self.get_inbox_capacity(channel, channel_count):
+            raise ChannelFull(channel)
+
+        pipeline = shard.pipeline(transaction=False)
+        pipeline.rpush(inbox_key, self.build_payload(channel, self.encode_message(message)))
+        pipeline.expire(inbox_key, self.expiry)
+        await pipeline.execute()
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+
+        if "!" not in channel:
+            inbox_key = self.get_inbox_key(channel)
+            while True:
+                result = await self.get_shard(inbox_key).blpop([inbox_key], timeout=self.blocking_timeout)
+                if result:
+                    return self.parse_payload(result[1])[1]
+
+        buffer = self.receive_buffers.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        while True:
+            # Waiters also watch the shared inbox task, so a failure (e.g. a lost redis
+            # connection) is raised in every receive() instead of leaving them parked forever
+            receive_task = self.ensure_receive_task(channel)
+            getter = asyncio.ensure_future(buffer.get())
+            try:
+                await asyncio.wait([getter, receive_task], return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                # The consumer has disconnected; anything still buffered for it is dropped
+                getter.cancel()
+                self.discard_channel(channel)
+                raise
+            if getter.done():
+                return getter.result()
+            getter.cancel()
+            if not receive_task.cancelled():
+                # The next receive() starts a fresh inbox task
+                receive_task.result()
+
+    def ensure_receive_task(self, channel):
+        loop = asyncio.get_running_loop()
+        receive_task = self.receive_tasks.get(loop)
+        if receive_task is None or receive_task.done():
+            receive_task = self.receive_tasks[loop] = loop.create_task(self.receive_inbox(self.get_inbox_key(channel)))
+        return receive_task
+
+    async def receive_inbox(self, inbox_key):
+        shard = self.get_shard(inbox_key)
+        while True:
+            result = await shard.blpop([inbox_key], timeout=self.blocking_timeout)
+            if result:
+                channel, message = self.parse_payload(result[1])
+                buffer = self.receive_buffers.get(channel)
+                # Messages for consumers that have gone away or fallen `capacity` messages behind are dropped
+                if buffer is not None and not buffer.full():
+                    buffer.put_nowait(message)
+
+    async def flush(self):
+        for shard in self.get_shards():
+            keys = [key async for key in shard.scan_iter(match=f"{self.prefix}:*")]
+            if keys:
+                await shard.delete(*keys)
+        self.receive_buffers.clear()
+        for receive_task in self.receive_tasks.values():
+            receive_task.cancel()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        group_key = self.get_group_key(group)
+        pipeline = self.get_shard(group_key).pipeline(transaction=False)
+        pipeline.zadd(group_key, {channel: time()})
+        pipeline.expire(group_key, self.group_expiry)
+        await pipeline.execute()
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        await self.get_shard(self.get_group_key(group)).zrem(self.get_group_key(group), channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+
+        group_key = self.get_group_key(group)
+        group_shard = self.get_shard(group_key)
+        await group_shard.zremrangebyscore(group_key, 0, time() - self.group_expiry)
+        channels = [channel.decode("utf-8") for channel in await group_shard.zrange(group_key, 0, -1)]
+        if not channels:
+            return
+
+        # Inbox lengths and channel counts are read in one pipeline per shard, so full inboxes
+        # are skipped (as send() refuses them) without a round trip per channel
+        inbox_keys = {channel: self.get_inbox_key(channel) for channel in channels}
+        shard_inboxes = defaultdict(list)
+        for inbox_key in set(inbox_keys.values()):
+            shard_inboxes[self.get_shard_index(inbox_key)].append(inbox_key)
+        inbox_lengths = {}
+        channel_counts = {}
+        for shard_index, shard_inbox_keys, results in await asyncio.gather(
+            *(self.get_inbox_lengths(shard_index, keys) for shard_index, keys in shard_inboxes.items())
+        ):
+            inbox_lengths.update(zip(shard_inbox_keys, results[::2]))
+            channel_counts.update(zip(shard_inbox_keys, results[1::2]))
+
+        body = self.encode_message(message)
+        pipelines = {}
+        for channel, inbox_key in inbox_keys.items():
+            if inbox_lengths[inbox_key] >= self.get_inbox_capacity(channel, channel_counts[inbox_key]):
+                continue
+            inbox_lengths[inbox_key] += 1
+            shard_index = self.get_shard_index(inbox_key)
+            if shard_index not in pipelines:
+                pipelines[shard_index] = self.get_shards()[shard_index].pipeline(transaction=False)
+            pipelines[shard_index].rpush(inbox_key, self.build_payload(channel, body))
+            pipelines[shard_index].expire(inbox_key, self.expiry)
+
+        await asyncio.gather(*(pipeline.execute() for pipeline in pipelines.values()))
+
+    async def get_inbox_lengths(self, shard_index, inbox_keys):
+        pipeline = self.get_shards()[shard_index].pipeline(transaction=False)
+        for inbox_key in inbox_keys:
+            pipeline.llen(inbox_key)
+            pipeline.get(self.get_channel_count_key(inbox_key))
+        return shard_index, inbox_keys, await pipeline.execute()
@@ -1,19 +1,38 @@
-from django.urls import resolve, reverse
+from django.urls import reverse, get_resolver, URLResolver
 from rest_framework.permissions import AllowAny
-from user.models import JWTAccessToken
+from user.utils import is_access_token_current, ais_access_token_current
 from django.shortcuts import redirect
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 
 
 class ClearAuthenticationHeaderMiddleware:
+    sync_capable = True
+    async_capable = True
+
     @staticmethod
-    def get_permission_class_app_name(request):
-        resolver_match = resolve(request.path_info)
-        app_names = resolver_match.app_names
-        view_function = resolver_match.func
+    def get_view_permissions(view_function, app_names):
         view_class = getattr(view_function, "view_class", None)
         permission_classes = getattr(view_class, "permission_classes", [])
-        return permission_classes, app_names
-    
+        return AllowAny in permission_classes, "admin" in app_names
+
+    @classmethod
+    def build_view_permissions(cls, url_patterns, app_names=()):
+        # (view, app names) -> (allows anyone, is admin), keyed the way ResolverMatch reports them
+        view_permissions = {}
+        for url_pattern in url_patterns:
+            if isinstance(url_pattern, URLResolver):
+                view_permissions.update(
+                    cls.build_view_permissions(
+                        url_pattern.url_patterns,
+                        app_names + (url_pattern.app_name,) if url_pattern.app_name else app_names,
+                    )
+                )
+            else:
+                view_permissions[(url_pattern.callback, app_names)] = cls.get_view_permissions(
+                    url_pattern.callback, app_names
+                )
+        return view_permissions
+
     @staticmethod
     def get_header_auth_token(request):
         token  = None
@@ -22,21 +41,48 @@ class ClearAuthenticationHeaderMiddleware:
             if auth_header.startswith("Bearer "):
                 token = auth_header.split(" ")[1]
         return token
-    
+
     def __init__(self, get_response):
         self.get_response = get_response
-        
+        self.view_permissions = self.build_view_permissions(get_resolver().url_patterns)
+        # Under ASGI the handler awaits process_view directly instead of running it in a thread
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+            self.process_view = self.aprocess_view
+
     def __call__(self, request):
-        if not self.process_request(request):
-            return redirect(reverse("error-401", kwargs={"exc": "Session expired. Kindly login again."}))
+        # In async mode this hands back get_response's coroutine for the handler to await
         return self.get_response(request)
-        
-    def process_request(self, request):
-        permission_classes, app_names = self.get_permission_class_app_name(request)
-        token = self.get_header_auth_token(request)
-        if any([AllowAny in permission_classes, "admin" in app_names]):
+
+    @staticmethod
+    def get_unauthorized_response():
+        return redirect(reverse("error-401", kwargs={"exc": "Session expired. Kindly login again."}))
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        token = self.clear_header_or_get_token(request, view_func)
+        if token and not is_access_token_current(token):
+            return self.get_unauthorized_response()
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        # The same check, with the token lookup run through sync_to_async on an in-process cache miss
+        token = self.clear_header_or_get_token(request, view_func)
+        if token and not await ais_access_token_current(token):
+            return self.get_unauthorized_response()
+        return None
+
+    def get_permissions(self, view_func, app_names):
+        key = (view_func, tuple(app_names))
+        permissions = self.view_permissions.get(key)
+        if permissions is None:
+            # Views outside the default URLconf (e.g. request.urlconf) are indexed on first use
+            permissions = self.view_permissions[key] = self.get_view_permissions(view_func, app_names)
+        return permissions
+
+    def clear_header_or_get_token(self, request, view_func):
+        allow_any, is_admin = self.get_permissions(view_func, request.resolver_match.app_names)
+        if any([allow_any, is_admin]):
             request.META.pop("HTTP_AUTHORIZATION", "")
-            return True
-        elif token and not JWTAccessToken.objects.filter(access_token=token).exists():
-            return False
-        return True
\ No newline at end of file
+            return None
+        return self.get_header_auth_token(request)
@@ -162,6 +162,8 @@ DEFAULT_FILE_STORAGE = "django.core.files.storage.FileSystemStorage"
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR/"media"
+MEDIA_STREAM_BLOCK_SIZE = 64 * 1024 # Bytes read per chunk when Django streams media itself
+MEDIA_ACCEL_REDIRECT_PREFIX = None # e.g. "/protected-media/" to let nginx send media via X-Accel-Redirect
 
 # REST Framework configuration
 REST_FRAMEWORK = {
@@ -191,6 +193,11 @@ SIMPLE_JWT = {
     "TOKEN_REFRESH_SERIALIZER": "user.serializers.RefreshTokenSerializer",
 }
 
+AUTH_TOKEN_CACHE_TTL = 2 # Seconds an access token checked by ClearAuthenticationHeaderMiddleware is reused in-process (capped by its expiry); other workers only see a rotation after it
+AUTH_TOKEN_CACHE_SIZE = 10000
+AUTH_TOKEN_SHARED_CACHE = None # Optional CACHES alias (e.g. a redis cache) shared by all workers
+AUTH_TOKEN_SHARED_CACHE_TTL = 300 # Seconds a user's current token is kept in the shared cache; rotation clears it at once
+
 AUTH_USER_MODEL = "user.User"
 
 SOCIAL_AUTH_USER_MODEL = "user.User"
@@ -223,6 +230,14 @@ EMAIL_PORT = os.getenv("EMAIL_PORT_VALUE")
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER_VALUE")
 EMAIL_HOST_PASSWORD = " ".join(os.getenv("EMAIL_HOST_PASSWORD_VALUE").split("_")) # Used '_' as a delimiter in place of spaces
 EMAIL_USE_TLS = True
+EMAIL_QUEUE_BATCH_SIZE = 100 # Queued emails claimed per worker pass
+EMAIL_QUEUE_MAX_ATTEMPTS = 5
+EMAIL_QUEUE_RETRY_DELAY = 30 # Seconds before the first retry, doubled after every failed attempt
+EMAIL_QUEUE_POLL_INTERVAL = 5 # Seconds the worker sleeps when the queue is empty
+EMAIL_QUEUE_RETENTION = 86400 # Seconds sent/failed emails (which contain verification links) are kept before the worker deletes them
+EMAIL_CONNECTION_POOL_SIZE = 2 # Open connections the worker keeps (and sends on in parallel)
+EMAIL_CONNECTION_BATCH_SIZE = 50 # Messages sent over one pooled connection per batch
+EMAIL_CONNECTION_MAX_IDLE = 60 # Seconds an unused connection is kept open
 
 
 # TOTP settings
@@ -239,8 +254,52 @@ AUTHENTICATION_BACKENDS =[
 ]
 
 # Channel layer settings
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer", # To be updated
-    },
+CHANNEL_LAYER_HOSTS = os.getenv("CHANNEL_LAYER_HOSTS_VALUE") # Comma-separated redis urls, one per shard
+if CHANNEL_LAYER_HOSTS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "portal.layers.ShardedChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_LAYER_HOSTS.split(","),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer", # Single process only
+        },
+    }
+
+# Chat settings
+CHAT_AUTH_CACHE_TTL = 5 # Seconds a websocket token/room membership lookup is reused; other workers only see a revocation after it
+CHAT_AUTH_CACHE_SIZE = 10000
+CHAT_PRESENCE_TIMEOUT = 90 # Seconds without a frame/heartbeat before a connection is dropped from presence
+CHAT_PRESENCE_PERSIST_DELAY = 1.0 # Seconds is_online changes are batched for
+CHAT_PRESENCE_BROADCAST_DELAY = 0.1 # Seconds chat.active broadcasts are coalesced for
+CHAT_MESSAGE_BATCH_WINDOW = 0 # Seconds new messages are collected for one bulk INSERT (0 inserts each message directly)
+CHAT_MESSAGE_BATCH_SIZE = 100
+CHAT_MESSAGE_WRITE_BEHIND = False # Broadcast before the INSERT and write messages in the background (see README)
+CHAT_MESSAGE_PAGE_SIZE = 10 # Messages per room history page (clients may ask for up to CHAT_MESSAGE_MAX_PAGE_SIZE)
+CHAT_MESSAGE_MAX_PAGE_SIZE = 100
+CHAT_NOTIFICATION_USERNAMES_LIMIT = 10 # Usernames listed in a join/leave notification before it switches to a count
+CHAT_NOTIFICATION_DELAY = 0.25 # Seconds join/leave notifications are merged for on each connection
+CHAT_TYPING_INTERVAL = 1.0 # Seconds between coalesced chat.typing events per room
+CHAT_TYPING_TIMEOUT = 5 # Seconds a user stays listed as typing after their last typing frame
+CHAT_TYPING_RATE_LIMIT = 0.5 # Minimum seconds between accepted typing frames per user
+CHAT_JSON_ENCODER = "json" # "orjson" encodes websocket frames with orjson (pip install orjson)
+CHAT_IMAGE_PROCESSES = 2 # Worker processes decoding uploaded images (0 runs them in threads)
+CHAT_IMAGE_THUMBNAIL_SIZE = 320 # Longest side of the WebP thumbnail sent with image messages
+CHAT_IMAGE_PLACEHOLDER_SIZE = 16 # Longest side of the inline placeholder image
+CHAT_MEDIA_FRAME_MAX_SIZE = 16 * 1024 * 1024 # Largest websocket binary frame accepted (inline media or upload chunk)
+CHAT_INLINE_MEDIA_CACHE_SIZE = 4 # Recently broadcast media files kept in memory for media=inline recipients
+CHAT_INLINE_MEDIA_CACHE_TTL = 10 # Seconds a broadcast media file is kept for media=inline recipients
+CHAT_MEDIA_MAX_SIZES = { # Largest file accepted per media format, inline or chunked
+    "image": 10 * 1024 * 1024,
+    "audio": 25 * 1024 * 1024,
+    "video": 200 * 1024 * 1024,
 }
+CHAT_UPLOAD_ROOT = BASE_DIR/"uploads" # Local directory chunked uploads are assembled in, whatever the media storage backend
+CHAT_UPLOAD_EXPIRY = 24 * 60 * 60 # Seconds after upload.begin an uncommitted chunked upload is deleted
+CHAT_UPLOAD_MAX_OPEN = 5 # Unfinished chunked uploads a user may have at once
+CHAT_UPLOAD_SWEEP_INTERVAL = 15 * 60 # Seconds between expire_media_uploads passes
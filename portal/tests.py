@@ -0,0 +1,201 @@
+from django.test import SimpleTestCase, TransactionTestCase, RequestFactory, override_settings
+from django.urls import resolve, reverse, path, include
+from django.http import JsonResponse
+from .layers import ShardedChannelLayer, LocalBroker
+from .middleware import ClearAuthenticationHeaderMiddleware
+from .daphne_server import ChatWebSocketFactory
+from asgiref.sync import iscoroutinefunction
+from user.views import RegisterView
+from chat.views import RoomListView
+from user.models import User, JWTAccessToken
+from user.utils import RefreshToken, access_token_cache, ais_access_token_current
+from unittest.mock import patch
+import asyncio
+
+
+async def async_view(request):
+    return JsonResponse({"is_authorized": "HTTP_AUTHORIZATION" in request.META})
+
+
+urlpatterns = [
+    path("async-view/", async_view),
+    path("", include("portal.urls")),
+]
+
+
+class ShardedChannelLayerTestCase(SimpleTestCase):
+    hosts = ["local://shard-0", "local://shard-1"]
+
+    def setUp(self):
+        # Two layer instances stand in for two worker processes sharing the same brokers
+        self.layer = ShardedChannelLayer(hosts=self.hosts)
+        self.layer2 = ShardedChannelLayer(hosts=self.hosts)
+
+    async def test_group_send_across_workers_success(self):
+        channel = await self.layer.new_channel()
+        channel2 = await self.layer2.new_channel()
+        await self.layer.group_add("room-id", channel)
+        await self.layer2.group_add("room-id", channel2)
+
+        await self.layer.group_send("room-id", {"type": "chat.active", "content": 2})
+        self.assertEqual(await self.layer.receive(channel), {"type": "chat.active", "content": 2})
+        self.assertEqual(await self.layer2.receive(channel2), {"type": "chat.active", "content": 2})
+
+        await self.layer2.group_discard("room-id", channel2)
+        await self.layer2.group_send("room-id", {"type": "chat.active", "content": 1})
+        self.assertEqual(await self.layer.receive(channel), {"type": "chat.active", "content": 1})
+        self.assertTrue(self.layer2.receive_buffers[channel2].empty())
+
+    async def test_send_to_channel_success(self):
+        channel = await self.layer2.new_channel()
+        await self.layer.send(channel, {"type": "chat.error", "content": "error"})
+        self.assertEqual(await self.layer2.receive(channel), {"type": "chat.error", "content": "error"})
+
+    async def test_frame_carried_verbatim_success(self):
+        channel = await self.layer2.new_channel()
+        await self.layer2.group_add("room-id", channel)
+        frame = '{"type": "chat.message", "text_content": "line one\\nline two"}'
+        await self.layer.group_send("room-id", {"type": "chat.message", "frame": frame})
+        self.assertEqual(await self.layer2.receive(channel), {"type": "chat.message", "frame": frame})
+
+    async def test_messages_for_gone_channels_dropped_success(self):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add("room-id", channel)
+        receive = asyncio.ensure_future(self.layer.receive(channel))
+        await asyncio.sleep(0)
+        receive.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await receive
+        self.assertNotIn(channel, self.layer.receive_buffers)
+        
+        # The inbox task keeps draining, but nothing is buffered for the gone consumer
+        other_channel = await self.layer.new_channel()
+        await self.layer.group_send("room-id", {"type": "chat.active", "content": 1})
+        await self.layer.send(other_channel, {"type": "chat.active", "content": 2})
+        self.assertEqual(await self.layer.receive(other_channel), {"type": "chat.active", "content": 2})
+        self.assertEqual(list(self.layer.receive_buffers), [other_channel])
+
+    async def test_inbox_failure_raised_in_receivers_success(self):
+        channel = await self.layer.new_channel()
+        broker = LocalBroker.from_url(self.hosts[self.layer.get_shard_index(self.layer.get_inbox_key(channel))])
+        blpop = broker.blpop
+        
+        async def failing_blpop(keys, timeout=0):
+            raise ConnectionError("connection lost")
+        
+        with patch.object(broker, "blpop", failing_blpop):
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(self.layer.receive(channel), 1)
+        
+        # The next receive() restarts the inbox task
+        self.assertIs(broker.blpop.__func__, blpop.__func__)
+        await self.layer.send(channel, {"type": "chat.active", "content": 1})
+        self.assertEqual(await asyncio.wait_for(self.layer.receive(channel), 1), {"type": "chat.active", "content": 1})
+
+    async def test_group_send_capacity_per_channel_success(self):
+        layer = ShardedChannelLayer(hosts=self.hosts, capacity=2)
+        channels = [await layer.new_channel() for index in range(5)]
+        for channel in channels:
+            await layer.group_add("room-id", channel)
+        await layer.group_send("room-id", {"type": "chat.active", "content": 1})
+        await layer.group_send("room-id", {"type": "chat.active", "content": 2})
+        
+        # All five channels share the worker's inbox, but each still gets its own `capacity`
+        for channel in channels:
+            self.assertEqual(await layer.receive(channel), {"type": "chat.active", "content": 1})
+            self.assertEqual(await layer.receive(channel), {"type": "chat.active", "content": 2})
+        
+        # A channel that falls behind loses its own messages without blocking the others
+        for index in range(3, 6):
+            await layer.group_send("room-id", {"type": "chat.active", "content": index})
+            await asyncio.sleep(0.01)
+        inbox_key = layer.get_inbox_key(channels[0])
+        self.assertEqual(await layer.get_shard(inbox_key).llen(inbox_key), 0)
+        for channel in channels:
+            self.assertEqual(await layer.receive(channel), {"type": "chat.active", "content": 3})
+            self.assertEqual(await layer.receive(channel), {"type": "chat.active", "content": 4})
+        self.assertTrue(all(buffer.empty() for buffer in layer.receive_buffers.values()))
+
+    async def test_groups_sharded_success(self):
+        channel = await self.layer.new_channel()
+        for index in range(20):
+            await self.layer.group_add(f"room-{index}", channel)
+
+        for host in self.hosts:
+            group_keys = [key async for key in LocalBroker.from_url(host).scan_iter(match="whisper:group:*")]
+            self.assertTrue(group_keys)
+
+    def tearDown(self):
+        for host in self.hosts:
+            LocalBroker.brokers.pop(host, None)
+
+
+class ClearAuthenticationHeaderMiddlewareTestCase(SimpleTestCase):
+    def setUp(self):
+        self.middleware = ClearAuthenticationHeaderMiddleware(lambda request: None)
+
+    def get_request(self, path):
+        request = RequestFactory().get(path, headers={"Authorization": "Bearer token"})
+        request.resolver_match = resolve(path)
+        return request
+
+    def test_view_permissions_indexed_success(self):
+        register_view = resolve(reverse("user:register")).func
+        room_list_view = resolve(reverse("chat:room-list")).func
+        self.assertEqual(register_view.view_class, RegisterView)
+        self.assertEqual(room_list_view.view_class, RoomListView)
+        self.assertEqual(self.middleware.view_permissions[(register_view, ("user",))], (True, False))
+        self.assertEqual(self.middleware.view_permissions[(room_list_view, ("chat",))], (False, False))
+        self.assertTrue(any(is_admin for allow_any, is_admin in self.middleware.view_permissions.values()))
+
+    def test_header_cleared_for_anonymous_views_success(self):
+        for path in [reverse("user:register"), reverse("admin:index")]:
+            request = self.get_request(path)
+            self.assertIsNone(self.middleware.process_view(request, request.resolver_match.func, (), {}))
+            self.assertNotIn("HTTP_AUTHORIZATION", request.META)
+
+    async def test_async_mode_success(self):
+        async def get_response(request):
+            return None
+        
+        middleware = ClearAuthenticationHeaderMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertTrue(iscoroutinefunction(middleware.process_view))
+        
+        request = self.get_request(reverse("user:register"))
+        self.assertIsNone(await middleware.process_view(request, request.resolver_match.func, (), {}))
+        self.assertNotIn("HTTP_AUTHORIZATION", request.META)
+        
+        request = self.get_request(reverse("chat:room-list"))
+        response = await middleware.process_view(request, request.resolver_match.func, (), {})
+        self.assertEqual(response.status_code, 302)
+
+
+class ChatWebSocketFactoryTestCase(SimpleTestCase):
+    @override_settings(CHAT_MEDIA_FRAME_MAX_SIZE=1024)
+    def test_message_size_capped_success(self):
+        factory = ChatWebSocketFactory(None)
+        self.assertEqual(factory.maxMessagePayloadSize, 1024)
+        self.assertEqual(factory.maxFramePayloadSize, 1024)
+
+
+@override_settings(ROOT_URLCONF=__name__, MIDDLEWARE=["portal.middleware.ClearAuthenticationHeaderMiddleware"])
+class AsyncMiddlewareChainTestCase(TransactionTestCase):
+    def setUp(self):
+        access_token_cache.clear()
+        self.user = User.objects.create_user(email="admin@gmail.com", is_email_verified=True)
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        JWTAccessToken.objects.filter(user=self.user).update(access_token=self.token)
+
+    async def test_token_checked_before_async_view_success(self):
+        with patch("portal.middleware.ais_access_token_current", wraps=ais_access_token_current) as check:
+            response = await self.async_client.get("/async-view/", headers={"Authorization": f"Bearer {self.token}"})
+            self.assertEqual(response.json(), {"is_authorized": True})
+            
+            await JWTAccessToken.objects.filter(user=self.user).aupdate(
+                access_token=str(RefreshToken.for_user(self.user).access_token)
+            )
+            access_token_cache.clear()
+            response = await self.async_client.get("/async-view/", headers={"Authorization": f"Bearer {self.token}"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(check.call_count, 2)
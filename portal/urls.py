@@ -19,7 +19,7 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
 from .error import Error401View, Error404View, Error500View
-from django.conf.urls.static import static
+from chat.views import MediaView
 from django.conf import settings
 
 
@@ -35,6 +35,6 @@ urlpatterns = [
     path("api/error/401/<str:exc>/", Error401View.as_view(), name="error-401"),  
     path("api/error/404/<str:exc>/", Error404View.as_view(), name="error-404"),  
     path("api/error/500/<str:exc>/", Error500View.as_view(), name="error-500"),
-]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:media_name>", MediaView.as_view(), name="media"),
+]
\ No newline at end of file
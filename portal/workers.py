@@ -0,0 +1,11 @@
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+
+from django.conf import settings
+from uvicorn.workers import UvicornWorker
+
+
+class ChatUvicornWorker(UvicornWorker):
+    # Websocket messages over the consumer's own limit are refused by uvicorn before being buffered
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "ws_max_size": settings.CHAT_MEDIA_FRAME_MAX_SIZE}
@@ -1,5 +1,5 @@
 from django.contrib.admin import register, ModelAdmin
-from .models import User, UserOTP, JWTAccessToken
+from .models import User, UserOTP, JWTAccessToken, QueuedEmail
 
 
 @register(User)
@@ -64,3 +64,21 @@ class JWTAccessTokenAdmin(ModelAdmin):
         "user",
         "created"
     ]
+    
+
+@register(QueuedEmail)
+class QueuedEmailAdmin(ModelAdmin):
+    list_display = [
+        "subject",
+        "recipient",
+        "status",
+        "attempts",
+        "next_attempt",
+        "created",
+        "sent",
+    ]
+    
+    list_filter = [
+        "status",
+        "created",
+    ]
@@ -2,4 +2,10 @@ from django.db.models import TextChoices
 
 
 class OTPTypeChoices(TextChoices):
-    EMAIL = "EML", "Email"
\ No newline at end of file
+    EMAIL = "EML", "Email"
+
+
+class EmailStatusChoices(TextChoices):
+    PENDING = "PEN", "Pending"
+    SENT = "SNT", "Sent"
+    FAILED = "FLD", "Failed"
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from user.utils import EmailQueue
+from time import sleep
+
+
+class Command(BaseCommand):
+    help = "Send queued emails over pooled connections, retrying failed deliveries with exponential backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Send the emails that are due and exit.")
+        parser.add_argument("--batch-size", type=int)
+        parser.add_argument("--poll-interval", type=float, default=settings.EMAIL_QUEUE_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        email_queue = EmailQueue(batch_size=options["batch_size"])
+        try:
+            while True:
+                sent_count, failed_count = email_queue.deliver()
+                if sent_count or failed_count:
+                    metrics = email_queue.connection_pool.metrics.as_dict()
+                    self.stdout.write(
+                        f"Sent {sent_count} emails, {failed_count} failed. "
+                        f"Total: {metrics['sent']} sent, {metrics['failed']} failed in {metrics['batches']} batches "
+                        f"over {metrics['connections_opened']} connections ({metrics['throughput']:.1f} emails/s)."
+                    )
+                purged_count = email_queue.purge()
+                if purged_count:
+                    self.stdout.write(f"Deleted {purged_count} finished emails past retention.")
+                if options["once"]:
+                    break
+                if sent_count + failed_count < email_queue.batch_size:
+                    sleep(options["poll_interval"])
+        finally:
+            email_queue.connection_pool.close()
@@ -11,10 +11,11 @@ from django.db.models import (
     DateTimeField,
     OneToOneField,
     CASCADE,
-    
+    TextField,
+    PositiveSmallIntegerField,
 )
 from .utils import generate_username, generate_access_token
-from .choices import OTPTypeChoices
+from .choices import OTPTypeChoices, EmailStatusChoices
 from nanoid import generate
 from django.utils import timezone
 from datetime import timedelta
@@ -116,4 +117,27 @@ class JWTAccessToken(Model):
     def save(self, *args, **kwargs) -> None:
         if not self.access_token:
             self.access_token = generate_access_token()
-        return super().save(*args, **kwargs)
\ No newline at end of file
+        return super().save(*args, **kwargs)
+
+
+class QueuedEmail(Model):
+    subject = CharField(max_length=255)
+    message = TextField()
+    html_message = TextField(blank=True)
+    from_email = CharField(max_length=255, blank=True, null=True)
+    recipient = EmailField()
+    status = CharField(
+        max_length=3, choices=EmailStatusChoices.choices, default=EmailStatusChoices.PENDING, db_index=True
+    )
+    attempts = PositiveSmallIntegerField(default=0)
+    next_attempt = DateTimeField(default=timezone.now, db_index=True)
+    last_error = TextField(blank=True)
+    created = DateTimeField(auto_now_add=True)
+    sent = DateTimeField(blank=True, null=True, db_index=True)
+
+    class Meta:
+        db_table = "user_queued_email"
+        ordering = ["next_attempt"]
+
+    def __str__(self):
+        return f"{self.subject} to {self.recipient}"
@@ -1,7 +1,8 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from .models import User, JWTAccessToken
-from .utils import OTPEmail
+from .utils import OTPEmail, forget_access_token
+from django.db.transaction import on_commit
 
 
 @receiver(post_save, sender=User)
@@ -12,4 +13,10 @@ def send_otp_email(sender, instance, created, **kwargs):
             if not instance.is_social_user:
                 OTPEmail(instance.email, check_db=True).send_check_all()
     except Exception as e:
-        raise Exception(f"{e}")
\ No newline at end of file
+        raise Exception(f"{e}")
+
+
+@receiver(post_save, sender=JWTAccessToken)
+def forget_cached_access_token(sender, instance, **kwargs):
+    # Rotations happen inside atomic blocks, so drop the cached token once the new one is visible
+    on_commit(lambda: forget_access_token(instance.user_id))
@@ -1,8 +1,29 @@
 from rest_framework.test import APITransactionTestCase
 from django.urls import reverse
-from .models import User, UserOTP
-from .utils import OTPEmail
+from .models import User, UserOTP, QueuedEmail, JWTAccessToken
+from .utils import (
+    OTPEmail,
+    RefreshToken,
+    is_access_token_current,
+    ais_access_token_current,
+    access_token_cache,
+    EmailQueue,
+    EmailConnectionPool,
+)
+from .choices import EmailStatusChoices
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.utils import timezone
+from smtplib import SMTPException
+from unittest.mock import patch
+from io import StringIO
 from django_otp.plugins.otp_totp.models import TOTPDevice
+from django.test import override_settings
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from time import monotonic
+from datetime import timedelta
 
 
 class RegisterVerifyEmailTestCase(APITransactionTestCase):
@@ -24,6 +45,13 @@ class RegisterVerifyEmailTestCase(APITransactionTestCase):
             self.assertIn(item, response.data)
         user = User.objects.filter(email=response.data["email"]).first()
         self.assertTrue(user.is_otp_email_sent)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(QueuedEmail.objects.filter(recipient=user.email, status=EmailStatusChoices.PENDING).exists())
+        
+        call_command("send_queued_emails", "--once", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [user.email])
+        self.assertEqual(QueuedEmail.objects.get(recipient=user.email).status, EmailStatusChoices.SENT)
             
     def test_verify_begin_success(self):
         response = self.client.post(self.verify_begin,
@@ -78,4 +106,129 @@ class TOTPCreateVerifyTestCase(APITransactionTestCase):
     def test_get_qrcode_success(self):
         self.client.post(self.device_create)
         response = self.client.post(self.qrcode)
-        self.assertTrue(type(response.data) == bytes)
\ No newline at end of file
+        self.assertTrue(type(response.data) == bytes)
+        
+        
+class AccessTokenCacheTestCase(APITransactionTestCase):
+    def setUp(self):
+        access_token_cache.clear()
+        self.user = User.objects.create_user(email="admin@gmail.com", is_email_verified=True)
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.user.access_token.access_token = self.token
+        self.user.access_token.save(update_fields=["access_token"])
+
+    def test_access_token_cached_until_rotation_success(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(is_access_token_current(self.token))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_access_token_current(self.token))
+        
+        new_token = str(RefreshToken.for_user(self.user).access_token)
+        self.user.access_token.access_token = new_token
+        self.user.access_token.save(update_fields=["access_token"])
+        self.assertFalse(is_access_token_current(self.token))
+        self.assertTrue(is_access_token_current(new_token))
+        self.assertFalse(is_access_token_current("invalid-token"))
+
+    @override_settings(AUTH_TOKEN_SHARED_CACHE="default")
+    def test_shared_cache_used_after_local_miss_success(self):
+        self.assertTrue(is_access_token_current(self.token))
+        access_token_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertTrue(is_access_token_current(self.token))
+        
+        self.user.access_token.access_token = str(RefreshToken.for_user(self.user).access_token)
+        self.user.access_token.save(update_fields=["access_token"])
+        with self.assertNumQueries(1):
+            self.assertFalse(is_access_token_current(self.token))
+
+    def test_rotation_elsewhere_seen_after_local_ttl_success(self):
+        self.assertTrue(async_to_sync(ais_access_token_current)(self.token))
+        # Rotated by another worker: this process's signal never fires
+        JWTAccessToken.objects.filter(user=self.user).update(
+            access_token=str(RefreshToken.for_user(self.user).access_token)
+        )
+        self.assertTrue(async_to_sync(ais_access_token_current)(self.token))
+        
+        with patch("portal.cache.monotonic", return_value=monotonic() + settings.AUTH_TOKEN_CACHE_TTL):
+            self.assertFalse(async_to_sync(ais_access_token_current)(self.token))
+        
+        
+class QueuedEmailTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.queued_email = QueuedEmail.objects.create(subject="subject", message="message", recipient="admin@gmail.com")
+
+    def test_failed_delivery_retried_with_backoff_success(self):
+        with patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=SMTPException("unavailable")):
+            call_command("send_queued_emails", "--once", stdout=StringIO())
+        self.queued_email.refresh_from_db()
+        self.assertEqual(self.queued_email.status, EmailStatusChoices.PENDING)
+        self.assertEqual(self.queued_email.attempts, 1)
+        self.assertEqual(self.queued_email.last_error, "unavailable")
+        self.assertGreater(self.queued_email.next_attempt, timezone.now())
+        
+        # Not due yet, so the next pass leaves it alone
+        call_command("send_queued_emails", "--once", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+        
+        QueuedEmail.objects.update(next_attempt=timezone.now())
+        call_command("send_queued_emails", "--once", stdout=StringIO())
+        self.queued_email.refresh_from_db()
+        self.assertEqual(self.queued_email.status, EmailStatusChoices.SENT)
+        self.assertEqual(self.queued_email.attempts, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_QUEUE_MAX_ATTEMPTS=1)
+    def test_delivery_stops_after_max_attempts_success(self):
+        with patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=SMTPException("unavailable")):
+            call_command("send_queued_emails", "--once", stdout=StringIO())
+        self.queued_email.refresh_from_db()
+        self.assertEqual(self.queued_email.status, EmailStatusChoices.FAILED)
+
+    def test_finished_emails_purged_after_retention_success(self):
+        expired = timezone.now() - timedelta(seconds=settings.EMAIL_QUEUE_RETENTION + 1)
+        QueuedEmail.objects.update(status=EmailStatusChoices.SENT, sent=expired)
+        email_fields = {"subject": "subject", "message": "message", "recipient": "user@gmail.com"}
+        recent_email = QueuedEmail.objects.create(**email_fields, status=EmailStatusChoices.SENT, sent=timezone.now())
+        failed_email = QueuedEmail.objects.create(**email_fields, status=EmailStatusChoices.FAILED, next_attempt=expired)
+        pending_email = QueuedEmail.objects.create(**email_fields, next_attempt=timezone.now() + timedelta(days=2))
+        
+        stdout = StringIO()
+        call_command("send_queued_emails", "--once", stdout=stdout)
+        self.assertIn("Deleted 2 finished emails", stdout.getvalue())
+        self.assertEqual(set(QueuedEmail.objects.values_list("id", flat=True)), {recent_email.id, pending_email.id})
+        self.assertFalse(QueuedEmail.objects.filter(id=failed_email.id).exists())
+
+    def test_failures_recorded_per_message_success(self):
+        QueuedEmail.objects.bulk_create(
+            [QueuedEmail(subject="subject", message="message", recipient=f"user{index}@gmail.com") for index in range(4)]
+        )
+        send_messages = EmailBackend.send_messages
+        
+        def reject_recipient(backend, messages):
+            if messages[0].to == ["user1@gmail.com"]:
+                raise SMTPException("mailbox unavailable")
+            return send_messages(backend, messages)
+        
+        email_queue = EmailQueue(connection_pool=EmailConnectionPool(size=1, batch_size=5))
+        with patch.object(EmailBackend, "send_messages", reject_recipient):
+            self.assertEqual(email_queue.deliver(), (4, 1))
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(QueuedEmail.objects.get(recipient="user1@gmail.com").last_error, "mailbox unavailable")
+        self.assertEqual(QueuedEmail.objects.filter(status=EmailStatusChoices.SENT).count(), 4)
+        self.assertEqual(email_queue.connection_pool.metrics.as_dict()["connections_opened"], 2)
+
+    def test_batches_sent_over_pooled_connections_success(self):
+        QueuedEmail.objects.bulk_create(
+            [QueuedEmail(subject="subject", message="message", recipient=f"user{index}@gmail.com") for index in range(4)]
+        )
+        email_queue = EmailQueue(connection_pool=EmailConnectionPool(size=1, batch_size=2))
+        self.assertEqual(email_queue.deliver(), (5, 0))
+        self.assertEqual(email_queue.deliver(), (0, 0))
+        self.assertEqual(len(mail.outbox), 5)
+        
+        metrics = email_queue.connection_pool.metrics.as_dict()
+        self.assertEqual(metrics["sent"], 5)
+        self.assertEqual(metrics["batches"], 3)
+        self.assertEqual(metrics["connections_opened"], 1)
+        self.assertGreater(metrics["throughput"], 0)
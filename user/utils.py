@@ -1,16 +1,26 @@
 from nanoid import generate
-from .choices import OTPTypeChoices
+from .choices import OTPTypeChoices, EmailStatusChoices
 from pyotp import TOTP, random_base32
 from django.core import signing
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.conf import settings
-from smtplib import SMTPException
 from rest_framework.exceptions import ValidationError
 from django.db.transaction import atomic
+from django.db.models import Q
 from rest_framework.renderers import BaseRenderer
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.exceptions import TokenError
 from django.contrib.sessions.exceptions import SessionInterrupted
+from django.core.cache import caches
+from asgiref.sync import sync_to_async
+from portal.cache import TTLCache
+from django.utils import timezone
+from datetime import timedelta
+from time import time, monotonic
+from threading import Lock
+from queue import LifoQueue, Empty
+from concurrent.futures import ThreadPoolExecutor
+import jwt
 
 
 def generate_username():
@@ -19,6 +29,64 @@ def generate_username():
 
 def generate_access_token():
     return f"access-{generate(size=10)}"
+
+
+access_token_cache = TTLCache(maxsize=settings.AUTH_TOKEN_CACHE_SIZE, ttl=settings.AUTH_TOKEN_CACHE_TTL)
+
+
+def get_access_token_shared_cache():
+    if settings.AUTH_TOKEN_SHARED_CACHE:
+        return caches[settings.AUTH_TOKEN_SHARED_CACHE]
+    return None
+
+
+def get_access_token_claims(access_token):
+    # Only the claims are read here; the signature and expiry are still checked by JWTAuthentication
+    try:
+        payload = jwt.decode(access_token, options={"verify_signature": False})
+        return payload["user_id"], payload["exp"]
+    except (jwt.InvalidTokenError, KeyError):
+        return None, None
+
+
+def is_access_token_current(access_token):
+    """Whether `access_token` is the one stored in the user's JWTAccessToken row."""
+    from .models import JWTAccessToken
+    
+    if access_token_cache.get(access_token):
+        return True
+    user_id, expiry = get_access_token_claims(access_token)
+    if user_id is None:
+        return False
+    
+    shared_cache = get_access_token_shared_cache()
+    current_access_token = shared_cache.get(f"access-token:{user_id}") if shared_cache else None
+    if current_access_token is None:
+        current_access_token = JWTAccessToken.objects.filter(user_id=user_id).values_list(
+            "access_token", flat=True
+        ).first()
+        if current_access_token and shared_cache:
+            shared_cache.set(
+                f"access-token:{user_id}", current_access_token, timeout=settings.AUTH_TOKEN_SHARED_CACHE_TTL
+            )
+    if current_access_token != access_token:
+        return False
+    access_token_cache.set(access_token, user_id, ttl=expiry - time())
+    return True
+
+
+async def ais_access_token_current(access_token):
+    # Only a miss of the in-process cache pays for the thread hop
+    if access_token_cache.get(access_token):
+        return True
+    return await sync_to_async(is_access_token_current)(access_token)
+
+
+def forget_access_token(user_id):
+    access_token_cache.delete_where(lambda access_token, token_user_id: token_user_id == user_id)
+    shared_cache = get_access_token_shared_cache()
+    if shared_cache:
+        shared_cache.delete(f"access-token:{user_id}")
     
     
 class OTPEmail:
@@ -77,21 +145,7 @@ class OTPEmail:
                 </body>
             </html>
         """
-        try:
-            send_mail(
-                subject=subject,
-                message=html_message,
-                from_email=sender_email,
-                recipient_list=[self.email],
-                html_message=html_message,
-                fail_silently=False,
-                auth_user=settings.EMAIL_HOST_USER,
-                auth_password=settings.EMAIL_HOST_PASSWORD
-            )
-        except SMTPException as e:
-            raise Exception({"smtp error": f"{e}"})
-        except Exception as e:
-            raise Exception({"untracked error": f"{e}"})
+        EmailQueue().enqueue(subject, html_message, self.email, html_message=html_message, from_email=sender_email)
         
     def decode_signed_token(self):
         try:
@@ -108,6 +162,201 @@ class OTPEmail:
             self.user.save(update_fields=["is_otp_email_sent"])
             
 
+class EmailQueue:
+    """
+    Database-backed outbox. Requests only enqueue; the `send_queued_emails` worker claims
+    due rows, sends them through the connection pool and retries failures with
+    exponential backoff.
+    """
+
+    def __init__(self, batch_size=None, max_attempts=None, retry_delay=None, connection_pool=None):
+        from .models import QueuedEmail
+        
+        self.queued_email_model = QueuedEmail
+        self.connection_pool = connection_pool or EmailConnectionPool()
+        self.batch_size = batch_size or settings.EMAIL_QUEUE_BATCH_SIZE
+        self.max_attempts = max_attempts or settings.EMAIL_QUEUE_MAX_ATTEMPTS
+        self.retry_delay = settings.EMAIL_QUEUE_RETRY_DELAY if retry_delay is None else retry_delay
+
+    def enqueue(self, subject, message, recipient, html_message="", from_email=None):
+        return self.queued_email_model.objects.create(
+            subject=subject,
+            message=message,
+            html_message=html_message,
+            from_email=from_email,
+            recipient=recipient,
+        )
+
+    def get_retry_time(self, attempts):
+        return timezone.now() + timedelta(seconds=self.retry_delay * 2 ** (attempts - 1))
+
+    def claim(self):
+        # Claiming counts the attempt and pushes next_attempt back, so a row is neither
+        # picked by another worker nor lost if this one dies while sending.
+        with atomic():
+            queued_emails = list(
+                self.queued_email_model.objects.select_for_update(skip_locked=True).filter(
+                    status=EmailStatusChoices.PENDING, next_attempt__lte=timezone.now()
+                )[:self.batch_size]
+            )
+            for queued_email in queued_emails:
+                queued_email.attempts += 1
+                queued_email.next_attempt = self.get_retry_time(queued_email.attempts)
+            self.queued_email_model.objects.bulk_update(queued_emails, ["attempts", "next_attempt"])
+        return queued_emails
+
+    @staticmethod
+    def build_message(queued_email):
+        message = EmailMultiAlternatives(
+            subject=queued_email.subject,
+            body=queued_email.message,
+            from_email=queued_email.from_email,
+            to=[queued_email.recipient],
+        )
+        if queued_email.html_message:
+            message.attach_alternative(queued_email.html_message, "text/html")
+        return message
+
+    def deliver(self):
+        queued_emails = self.claim()
+        batches = [
+            queued_emails[index:index + self.connection_pool.batch_size]
+            for index in range(0, len(queued_emails), self.connection_pool.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.connection_pool.size) as executor:
+            futures = [
+                executor.submit(self.connection_pool.send_batch, [self.build_message(queued_email) for queued_email in batch])
+                for batch in batches
+            ]
+        
+        sent_count = failed_count = 0
+        for batch, future in zip(batches, futures):
+            # Each row is marked from its own message's outcome
+            for queued_email, error in zip(batch, future.result()):
+                if error:
+                    queued_email.last_error = f"{error}"
+                    if queued_email.attempts >= self.max_attempts:
+                        queued_email.status = EmailStatusChoices.FAILED
+                    failed_count += 1
+                else:
+                    queued_email.status = EmailStatusChoices.SENT
+                    queued_email.sent = timezone.now()
+                    sent_count += 1
+        self.queued_email_model.objects.bulk_update(queued_emails, ["status", "sent", "last_error"])
+        return sent_count, failed_count
+
+    def purge(self):
+        # Finished rows still hold the verification links, so they are only kept for EMAIL_QUEUE_RETENTION
+        cutoff = timezone.now() - timedelta(seconds=settings.EMAIL_QUEUE_RETENTION)
+        return self.queued_email_model.objects.filter(
+            Q(status=EmailStatusChoices.SENT, sent__lt=cutoff)
+            | Q(status=EmailStatusChoices.FAILED, next_attempt__lt=cutoff)
+        ).delete()[0]
+
+
+class EmailMetrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.started = monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.batches = 0
+        self.connections_opened = 0
+
+    def record(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def get_throughput(self):
+        return self.sent / max(monotonic() - self.started, 1e-6)
+
+    def as_dict(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "batches": self.batches,
+            "connections_opened": self.connections_opened,
+            "throughput": self.get_throughput(),
+        }
+
+
+class EmailConnectionPool:
+    """
+    Keeps up to `size` open (authenticated) email backend connections and sends each batch
+    of messages over one of them, reporting the outcome of every message. Connections idle for
+    more than `max_idle` seconds are closed rather than reused, since SMTP servers drop them.
+    """
+
+    def __init__(self, size=None, batch_size=None, max_idle=None):
+        self.size = size or settings.EMAIL_CONNECTION_POOL_SIZE
+        self.batch_size = batch_size or settings.EMAIL_CONNECTION_BATCH_SIZE
+        self.max_idle = settings.EMAIL_CONNECTION_MAX_IDLE if max_idle is None else max_idle
+        self.idle_connections = LifoQueue()
+        self.metrics = EmailMetrics()
+
+    def acquire(self):
+        while True:
+            try:
+                connection, released = self.idle_connections.get_nowait()
+            except Empty:
+                break
+            if monotonic() - released <= self.max_idle:
+                return connection
+            connection.close()
+        
+        connection = get_connection(
+            username=settings.EMAIL_HOST_USER, password=settings.EMAIL_HOST_PASSWORD, fail_silently=False
+        )
+        connection.open()
+        self.metrics.record(connections_opened=1)
+        return connection
+
+    def release(self, connection):
+        if self.idle_connections.qsize() < self.size:
+            self.idle_connections.put((connection, monotonic()))
+        else:
+            connection.close()
+
+    def send_batch(self, messages):
+        # Returns the error (or None) of each message. Messages are handed to the connection one at
+        # a time, so a rejected recipient fails alone; a connection that errored is replaced, and
+        # if no connection can be opened the remaining messages fail with that error.
+        errors = []
+        connection = connection_error = None
+        for message in messages:
+            if connection is None and connection_error is None:
+                try:
+                    connection = self.acquire()
+                except Exception as e:
+                    connection_error = e
+            if connection_error:
+                errors.append(connection_error)
+                continue
+            try:
+                connection.send_messages([message])
+            except Exception as e:
+                errors.append(e)
+                connection.close()
+                connection = None
+            else:
+                errors.append(None)
+        if connection is not None:
+            self.release(connection)
+        
+        failed_count = sum(error is not None for error in errors)
+        self.metrics.record(sent=len(messages) - failed_count, failed=failed_count, batches=1)
+        return errors
+
+    def close(self):
+        while True:
+            try:
+                connection, released = self.idle_connections.get_nowait()
+            except Empty:
+                return
+            connection.close()
+            
+
 class PNGRenderer(BaseRenderer):
     media_type = "image/png"
     format = "png"